@@ -0,0 +1,108 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+from contextlib import redirect_stdout
+from typing import List
+
+if __name__ == "__main__":
+    # Allow running this file directly, from any folder
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from src.bench.environment import BenchEnvironment, Step
+from src.bench.fake_discord import click_button
+from src.bot.embed_buttons import ButtonAction
+
+DEFAULT_SIZES = [100, 1000, 10000]
+
+
+async def commission_flow(env: BenchEnvironment, commission_id: int, artist: str):
+    """
+    Takes a commission from the incoming queue through to done: claim, invoice, pay and finish, each clicked on the
+    message the commission is on at the time
+    """
+    member = env.member_for(artist)
+    for action in [ButtonAction.Claim, ButtonAction.Invoiced, ButtonAction.Paid, ButtonAction.Done]:
+        message = await env.live_message(commission_id)
+        if message is None:
+            raise RuntimeError(f"Commission #{commission_id} has no message to click {action.name} on")
+        await click_button(env.fake, env.functions, message, action, member)
+
+
+async def run_dataset(size: int, args: argparse.Namespace) -> List[Step]:
+    async with BenchEnvironment(size, args.latency_ms / 1000, args.rate_limit, args.seed) as env:
+        f = env.functions
+        async with env.measure("sync"):
+            await f.update_commissions_information(randomize=False)
+        async with env.measure("sync, nothing new"):
+            await f.update_commissions_information(randomize=False)
+        async with env.measure("status board"):
+            await f.send_commissions_status()
+        async with env.measure("status board, unchanged"):
+            await f.send_commissions_status()
+        claimable = [c["id"] for c in await f.db.get_active_commissions()
+                     if c["assigned_to"] is None and c["allow_any_artist"]]
+        rng = random.Random(args.seed)
+        flows = [(commission_id, rng.choice(list(env.members)).name)
+                 for commission_id in rng.sample(claimable, min(args.flows, len(claimable)))]
+        async with env.measure(f"buttons, {len(flows)} commissions x 4 clicks"):
+            await asyncio.gather(*[commission_flow(env, commission_id, artist) for commission_id, artist in flows])
+        async with env.measure("status board, after clicks"):
+            await f.send_commissions_status()
+        async with env.measure("activity digest"):
+            await f.activity.flush()
+        # Also clears out the messages of the commissions finished above
+        async with env.measure("reconcile"):
+            await f.reconcile_messages()
+        async with env.measure("cleanup and resend"):
+            await f.cleanup_and_resend_messages(randomize=False)
+        return env.steps
+
+
+def print_report(results: dict, show_routes=False):
+    row_fmt = "{:>6} | {:<36} | {:>9} | {:>9} | {:>8} | {:>10} | {:>5}"
+    print(row_fmt.format("SIZE", "STEP", "SECONDS", "API CALLS", "DB CALLS", "STATEMENTS", "429S"))
+    for size, steps in results.items():
+        for step in steps:
+            print(row_fmt.format(size, step.name, f"{step.seconds:.3f}", step.api_calls, step.db_calls,
+                                 step.db_statements, step.rate_limits))
+            if show_routes:
+                for route, count in sorted(step.routes.items(), key=lambda item: -item[1]):
+                    print(f"{'':>6} |   {count:>6} {route}")
+
+
+def parse_rate_limit(value: str):
+    requests, seconds = value.split("/")
+    return int(requests), float(seconds)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the bot against a fake Discord and fake Google Sheets.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help="How many commissions to generate for each run")
+    parser.add_argument("--flows", type=int, default=100,
+                        help="How many commissions to take from claim to done with the buttons")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Added to every fake Discord API call")
+    parser.add_argument("--rate-limit", type=parse_rate_limit, default=None, metavar="REQUESTS/SECONDS",
+                        help="Per-channel rate limit of the fake Discord, e.g. 5/5")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--routes", action="store_true", help="Show the API calls of each step by route")
+    parser.add_argument("--verbose", action="store_true", help="Show the bot's own output while it runs")
+    parser.add_argument("--json", metavar="FILE", help="Also write the results to a JSON file, to compare runs")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for size in args.sizes:
+        print(f"Running with {size} commissions...")
+        with open(os.devnull, "w") as devnull, redirect_stdout(sys.stdout if args.verbose else devnull):
+            results[size] = asyncio.run(run_dataset(size, args))
+    print_report(results, args.routes)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({size: [step._asdict() for step in steps] for size, steps in results.items()}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
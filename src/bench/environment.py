@@ -0,0 +1,132 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+from contextlib import asynccontextmanager
+from time import perf_counter
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from src import metrics, utils
+from src.bench.fake_discord import FakeBot, FakeDiscord, FakeMessage, FakeUser
+from src.bench.fake_sheets import FakeSheets, generate_form_responses
+from src.bot import functions as functions_module
+from src.bot.functions import Functions
+from src.bot.sheets import load_form_sources
+from src.db import db as db_module
+from src.db.db import close_database
+
+ARTISTS = [f"Artist {i}" for i in range(1, 6)]
+
+
+def make_config(artists: List[str]) -> dict:
+    channels = {
+        "incoming-commissions": "!Any artist",
+        "voided-queue": "!Void",
+        "bot-spam": "!Bot",
+        "status": "!Status",
+    }
+    users = {}
+    for i, artist in enumerate(artists, start=1):
+        channels[f"artist-{i}-queue"] = artist
+        users[str(1000 + i)] = artist
+    return {"settings": {}, "channels": channels, "users": users}
+
+
+class Step(NamedTuple):
+    name: str
+    seconds: float
+    api_calls: int
+    routes: Dict[str, int]
+    db_calls: int
+    db_statements: int
+    rate_limits: int
+
+
+class BenchEnvironment:
+    """
+    A bot wired to a fake Discord and fake Sheets, with its config and database in a temporary folder. Use with
+    `async with BenchEnvironment(...) as env:`. Only one can be open at a time, since the bot's settings are module
+    globals.
+    """
+
+    def __init__(self, commissions: int, latency: float=0, rate_limit: Optional[Tuple[int, float]]=None, seed=0):
+        self.commissions = commissions
+        self.fake = FakeDiscord(latency, rate_limit)
+        self.seed = seed
+        self.folder: Optional[str] = None
+        self.old_db_file = db_module.DB_FILE
+        self.bot: Optional[FakeBot] = None
+        self.functions: Optional[Functions] = None
+        self.members: List[FakeUser] = []
+        self.steps: List[Step] = []
+
+    async def __aenter__(self) -> "BenchEnvironment":
+        self.folder = tempfile.mkdtemp(prefix="commission-bench-")
+        config_file = os.path.join(self.folder, "config.json")
+        with open(config_file, "w") as f:
+            json.dump(make_config(ARTISTS), f)
+        utils.load_config(config_file)
+        db_module.DB_FILE = os.path.join(self.folder, "main.db")
+        functions_module.FORM_SOURCES = load_form_sources({})
+        # Nothing runs on a timer during a benchmark; each step triggers its own work
+        functions_module.STATUS_REFRESH_SECONDS = 3600
+        functions_module.ACTIVITY_FLUSH_SECONDS = 3600
+        self.bot = FakeBot(self.fake)
+        self.functions = Functions(self.bot)
+        self.functions.sheets.close()
+        self.functions.sheets = FakeSheets(generate_form_responses(self.commissions, ARTISTS, self.seed))
+        await self.functions.db.add_channels(list(utils.CHANNELS))
+        self.functions.save_channels()
+        self.members = [FakeUser(self.fake, int(member_id), name) for member_id, name in utils.USERS.items()]
+        return self
+
+    async def __aexit__(self, *exc_info):
+        f = self.functions
+        for task in [f.status_task, f.activity.flush_task] + list(f.background_tasks):
+            if task is not None:
+                task.cancel()
+        f.outbound.close()
+        f.db.close()
+        close_database()
+        db_module.DB_FILE = self.old_db_file
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    @asynccontextmanager
+    async def measure(self, name: str):
+        """
+        Records how long the block takes, and the API calls, DB calls and SQL statements it makes, as a Step
+        """
+        calls = self.fake.calls.copy()
+        db_calls = metrics.DB_CALL_SECONDS.total_count()
+        db_statements = metrics.DB_STATEMENTS.total()
+        rate_limits = self.fake.rate_limited
+        start = perf_counter()
+        yield
+        # Let anything the block started in the background settle
+        await asyncio.sleep(0)
+        routes = {route: count - calls[route] for route, count in self.fake.calls.items() if count > calls[route]}
+        self.steps.append(Step(
+            name,
+            perf_counter() - start,
+            sum(routes.values()),
+            routes,
+            metrics.DB_CALL_SECONDS.total_count() - db_calls,
+            int(metrics.DB_STATEMENTS.total() - db_statements),
+            self.fake.rate_limited - rate_limits,
+        ))
+
+    def channel(self, name: str):
+        return self.bot.get_channel_by_name(name)
+
+    async def live_message(self, commission_id: int) -> Optional[FakeMessage]:
+        """
+        :return: The message the DB says the commission is on, if it exists
+        """
+        commission = await self.functions.db.get_commission_by_id(commission_id)
+        if commission["channel_name"] not in self.functions.channels:
+            return None
+        return self.channel(commission["channel_name"]).messages.get(commission["message_id"])
+
+    def member_for(self, artist: str) -> FakeUser:
+        return next(member for member in self.members if member.name == artist)
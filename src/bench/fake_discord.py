@@ -0,0 +1,295 @@
+import asyncio
+import itertools
+import logging
+from collections import Counter, OrderedDict, deque
+from datetime import datetime, timezone
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+import discord
+from discord.utils import snowflake_time, time_snowflake, utcnow
+
+from src import utils
+
+# Snowflake IDs for every fake object, starting from now so bulk deletes treat the messages as recent
+_ids = itertools.count(time_snowflake(utcnow()))
+
+
+class _NotFoundResponse:
+    status = 404
+    reason = "Not Found"
+
+
+def not_found() -> discord.NotFound:
+    return discord.NotFound(_NotFoundResponse(), "Unknown Message")
+
+
+class FakeDiscord:
+    """
+    Stands in for Discord's HTTP API. Every call a real client would make as a request is counted by route, slowed
+    down by latency, and rate limited per channel: at most rate_limit[0] requests every rate_limit[1] seconds, after
+    which the caller sleeps until the window frees up, the way discord.py handles a 429.
+    """
+
+    def __init__(self, latency: float=0, rate_limit: Optional[Tuple[int, float]]=None):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.calls: Counter = Counter()
+        self.rate_limited = 0
+        # When each channel's recent requests were made, for the rate limit
+        self.windows: Dict[int, Deque[float]] = {}
+
+    async def request(self, route: str, channel_id: int=None):
+        self.calls[route] += 1
+        if self.rate_limit and channel_id is not None:
+            limit, per = self.rate_limit
+            loop = asyncio.get_running_loop()
+            window = self.windows.setdefault(channel_id, deque())
+            while True:
+                now = loop.time()
+                while window and window[0] <= now - per:
+                    window.popleft()
+                if len(window) < limit:
+                    break
+                self.rate_limited += 1
+                retry_after = window[0] + per - now
+                # The same warning discord.py logs, so the bot's 429 counter sees it
+                logging.getLogger("discord.http").warning(
+                    "We are being rate limited. %s responded with 429. Retrying in %.2f seconds.", route, retry_after
+                )
+                await asyncio.sleep(retry_after)
+            window.append(loop.time())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+
+class FakeUser:
+
+    def __init__(self, fake: FakeDiscord, user_id: int, name: str):
+        self.fake = fake
+        self.id = user_id
+        self.name = name
+        self.dms: List[str] = []
+
+    async def send(self, content: str, **kwargs):
+        await self.fake.request("POST /users/@me/channels")
+        await self.fake.request("POST /channels/{channel_id}/messages")
+        self.dms.append(content)
+
+    def __str__(self):
+        return self.name
+
+
+class FakeMessage:
+
+    def __init__(self, channel: "FakeChannel", author: FakeUser, content: str=None, embed: discord.Embed=None,
+                 view: discord.ui.View=None):
+        self.id = next(_ids)
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.embeds = [embed] if embed else []
+        self.view = view
+
+    @property
+    def created_at(self) -> datetime:
+        return snowflake_time(self.id)
+
+    def apply_edit(self, **kwargs):
+        if "content" in kwargs:
+            self.content = kwargs["content"]
+        if "embed" in kwargs:
+            self.embeds = [kwargs["embed"]] if kwargs["embed"] else []
+        if "view" in kwargs:
+            self.view = kwargs["view"]
+
+    async def edit(self, **kwargs):
+        await self.channel.get_partial_message(self.id).edit(**kwargs)
+
+    async def delete(self):
+        await self.channel.get_partial_message(self.id).delete()
+
+
+class FakePartialMessage:
+
+    def __init__(self, channel: "FakeChannel", message_id: int):
+        self.channel = channel
+        self.id = message_id
+
+    async def edit(self, **kwargs):
+        await self.channel.fake.request("PATCH /channels/{channel_id}/messages/{message_id}", self.channel.id)
+        if self.id not in self.channel.messages:
+            raise not_found()
+        self.channel.messages[self.id].apply_edit(**kwargs)
+
+    async def delete(self):
+        await self.channel.fake.request("DELETE /channels/{channel_id}/messages/{message_id}", self.channel.id)
+        if self.channel.messages.pop(self.id, None) is None:
+            raise not_found()
+
+
+class FakeChannel:
+
+    def __init__(self, fake: FakeDiscord, bot_user: FakeUser, name: str):
+        self.fake = fake
+        self.bot_user = bot_user
+        self.id = next(_ids)
+        self.name = name
+        self.messages: "OrderedDict[int, FakeMessage]" = OrderedDict()
+
+    async def send(self, content: str=None, embed: discord.Embed=None, view: discord.ui.View=None) -> FakeMessage:
+        await self.fake.request("POST /channels/{channel_id}/messages", self.id)
+        message = FakeMessage(self, self.bot_user, content, embed, view)
+        self.messages[message.id] = message
+        return message
+
+    async def history(self, limit: Optional[int]=100, before=None):
+        # Newest first, one request per page of 100 like the real API
+        messages = [message for message in reversed(self.messages.values())
+                    if before is None or message.id < before.id][:limit]
+        for i, message in enumerate(messages):
+            if i % 100 == 0:
+                await self.fake.request("GET /channels/{channel_id}/messages", self.id)
+            yield message
+        if not messages:
+            await self.fake.request("GET /channels/{channel_id}/messages", self.id)
+
+    async def fetch_message(self, message_id: int) -> FakeMessage:
+        await self.fake.request("GET /channels/{channel_id}/messages/{message_id}", self.id)
+        if message_id not in self.messages:
+            raise not_found()
+        return self.messages[message_id]
+
+    def get_partial_message(self, message_id: int) -> FakePartialMessage:
+        return FakePartialMessage(self, message_id)
+
+    async def delete_messages(self, messages: Iterable):
+        await self.fake.request("POST /channels/{channel_id}/messages/bulk-delete", self.id)
+        for message in messages:
+            self.messages.pop(message.id, None)
+
+
+class FakeGuild:
+
+    def __init__(self, channels: List[FakeChannel]):
+        self.id = next(_ids)
+        self.channels = channels
+        self.emojis = []
+
+
+class FakeBot:
+    """
+    The parts of discord.ext.commands.Bot that Functions uses, with one guild holding a channel for every channel in
+    the loaded config
+    """
+
+    def __init__(self, fake: FakeDiscord, channel_names: Iterable[str]=None):
+        self.fake = fake
+        self.user = FakeUser(fake, next(_ids), "CommissionQueueBot")
+        channels = [FakeChannel(fake, self.user, name) for name in (channel_names or utils.CHANNELS)]
+        self.guilds = [FakeGuild(channels)]
+        self.channels_by_id = {channel.id: channel for channel in channels}
+        self.views_added = 0
+
+    def get_all_channels(self):
+        for guild in self.guilds:
+            yield from guild.channels
+
+    def get_guild(self, guild_id: int) -> Optional[FakeGuild]:
+        return next((guild for guild in self.guilds if guild.id == guild_id), None)
+
+    def get_channel(self, channel_id: int) -> Optional[FakeChannel]:
+        return self.channels_by_id.get(channel_id)
+
+    def get_channel_by_name(self, name: str) -> FakeChannel:
+        return next(channel for channel in self.get_all_channels() if channel.name == name)
+
+    def add_view(self, view: discord.ui.View, message_id: int=None):
+        self.views_added += 1
+
+
+class FakeInteractionResponse:
+
+    def __init__(self, interaction: "FakeInteraction"):
+        self.interaction = interaction
+        self.done = False
+
+    def is_done(self) -> bool:
+        return self.done
+
+    async def respond(self):
+        if self.done:
+            raise discord.InteractionResponded(self.interaction)
+        self.done = True
+        await self.interaction.fake.request("POST /interactions/{interaction_id}/{interaction_token}/callback")
+        # Once Discord has the response, so the time includes the round trip
+        self.interaction.acked_at = asyncio.get_running_loop().time()
+
+    async def defer(self, **kwargs):
+        await self.respond()
+
+    async def edit_message(self, **kwargs):
+        await self.respond()
+        self.interaction.message.apply_edit(**kwargs)
+
+    async def send_message(self, content: str=None, ephemeral=False, **kwargs):
+        await self.respond()
+        self.interaction.replies.append(content)
+
+
+class FakeFollowup:
+
+    def __init__(self, interaction: "FakeInteraction"):
+        self.interaction = interaction
+
+    async def send(self, content: str=None, ephemeral=False, **kwargs):
+        await self.interaction.fake.request("POST /webhooks/{application_id}/{interaction_token}")
+        self.interaction.replies.append(content)
+
+
+class FakeInteraction:
+    """
+    A button click on a message. Interaction responses and follow-ups go through webhooks, which aren't rate limited
+    per channel.
+    """
+
+    def __init__(self, fake: FakeDiscord, message: FakeMessage, user: FakeUser):
+        self.fake = fake
+        self.message = message
+        self.user = user
+        self.channel = message.channel
+        self.channel_id = message.channel.id
+        self.created_at = datetime.now(timezone.utc)
+        self.created_at_loop = asyncio.get_running_loop().time()
+        self.acked_at: Optional[float] = None
+        self.response = FakeInteractionResponse(self)
+        self.followup = FakeFollowup(self)
+        # Ephemeral replies and follow-ups sent to the clicking user
+        self.replies: List[str] = []
+
+    async def edit_original_response(self, **kwargs):
+        await self.fake.request("PATCH /webhooks/{application_id}/{interaction_token}/messages/@original")
+        self.message.apply_edit(**kwargs)
+
+
+async def click_button(fake: FakeDiscord, functions, message: FakeMessage, action, user: FakeUser) -> FakeInteraction:
+    """
+    Clicks one of the buttons on a message, the way discord.py dispatches a click to a persistent view
+    :param fake:
+    :param functions: The bot's Functions
+    :param message:
+    :param action: The ButtonAction to click. The message doesn't have to show that button, since a real click can
+        race with an edit that removes it.
+    :param user:
+    :return: The interaction, once the click has been handled
+    """
+    from src.bot.embed_buttons import EmbedButton
+    button = EmbedButton(action)
+    view = discord.ui.View(timeout=None)
+    view.functions_obj = functions
+    view.add_item(button)
+    interaction = FakeInteraction(fake, message, user)
+    await button.callback(interaction)
+    return interaction
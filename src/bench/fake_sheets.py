@@ -0,0 +1,74 @@
+import asyncio
+import random
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from src import utils
+
+
+class FakeSheets:
+    """
+    Stands in for SheetsClient, serving form responses from memory. Row 1 of each sheet is taken to be the header, so
+    rows[0] is spreadsheet row 2.
+    """
+
+    def __init__(self, sheets: Dict[str, List[list]], latency: float=0, timeout=30):
+        self.sheets = sheets
+        self.latency = latency
+        self.timeout = timeout
+        self.calls = 0
+
+    async def fetch(self, ranges: List[str]) -> List[List[list]]:
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        results = []
+        for sheet_range in ranges:
+            sheet_name, _, start_row, _, end_row = utils.parse_sheet_range(sheet_range)
+            rows = self.sheets.get(sheet_name, [])
+            # Like a form's responses sheet, the grid ends at the last response, and the API refuses ranges below it
+            if start_row > len(rows) + 1:
+                raise HttpError(httplib2.Response({"status": 400}),
+                                f'{{"error": {{"message": "Unable to parse range: {sheet_range}"}}}}'.encode())
+            end = None if end_row is None else end_row - 1
+            results.append([list(row) for row in rows[max(start_row - 2, 0):end]])
+        return results
+
+    def close(self):
+        pass
+
+
+def generate_form_responses(count: int, artists: List[str], seed=0,
+                            specialty_share=0.1) -> Dict[str, List[list]]:
+    """
+    Makes up form responses for a benchmark, spread over the two default form sources. Most ask for any artist; the
+    rest ask for a specific one, and some of those won't take anyone else.
+    :param count: How many responses, across both sheets
+    :param artists: Artist names that requests can name
+    :param seed: For repeatable datasets
+    :param specialty_share: The share of responses that go to the specialty sheet
+    :return: Rows for each sheet name
+    """
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    sheets = {"Form Responses 1": [], "Form Responses 2": []}
+    for i in range(count):
+        timestamp = (start + timedelta(minutes=i)).strftime("%m/%d/%Y %H:%M:%S")
+        if rng.random() < specialty_share:
+            # The specialty form appends a description to the artist's name, which the form source splits off
+            row = [timestamp, "Yes", f"user{i}@example.com", "", "", f"user{i}", "", f"Specialty request {i}", "", "",
+                   f"{rng.choice(artists)} (specialty)", "", f"User {i}"]
+            sheets["Form Responses 2"].append(row)
+            continue
+        if rng.random() < 0.6:
+            artist_choice, if_queue_is_full = "Any artist", ""
+        else:
+            artist_choice = rng.choice(artists)
+            if_queue_is_full = rng.choice(["Any artist is fine", "Cancel my request"])
+        row = [timestamp, "Yes", f"user{i}@example.com", f"twitch{i}", f"@twitter{i}", f"user{i}", "",
+               f"Description of request {i}", "Happy", "", artist_choice, if_queue_is_full, f"User {i}"]
+        sheets["Form Responses 1"].append(row)
+    return sheets
@@ -0,0 +1,246 @@
+import argparse
+import asyncio
+import os
+import random
+import sys
+from collections import Counter
+from contextlib import redirect_stdout
+from time import perf_counter
+from typing import Dict, List, NamedTuple, Optional
+
+if __name__ == "__main__":
+    # Allow running this file directly, from any folder
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from src import utils
+from src.bench.environment import BenchEnvironment
+from src.bench.fake_discord import FakeMessage, FakeUser, click_button
+from src.bot.embed_buttons import ButtonAction, EmbedButtonsView
+
+# How often each button is clicked, relative to the others. Most of the traffic is the claim rush.
+ACTION_WEIGHTS = {
+    ButtonAction.Claim: 30,
+    ButtonAction.Accept: 15,
+    ButtonAction.Reject: 15,
+    ButtonAction.Invoiced: 10,
+    ButtonAction.Paid: 10,
+    ButtonAction.Done: 5,
+    ButtonAction.Hide: 8,
+    ButtonAction.Show: 7,
+}
+
+
+class Click(NamedTuple):
+    commission_id: int
+    action: ButtonAction
+    ack_ms: float
+    total_ms: float
+    outcome: str
+
+
+class StressResult(NamedTuple):
+    clicks: List[Click]
+    seconds: float
+    members: int
+    api_calls: int
+    rate_limits: int
+    problems: List[str]
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def classify(replies: List[str]) -> str:
+    if not replies:
+        return "applied"
+    reply = replies[-1]
+    if "moved to a new message" in reply:
+        return "stale message"
+    if "changed right before you clicked" in reply:
+        return "conflict"
+    if "Something went wrong" in reply:
+        return "error"
+    return "refused"
+
+
+def pick_action(rng: random.Random, message: FakeMessage) -> Optional[ButtonAction]:
+    """
+    :return: One of the buttons on the message, weighted by ACTION_WEIGHTS, or None if it has no buttons
+    """
+    shown = {item.custom_id for item in message.view.children} if message.view else set()
+    actions = [action for action in ACTION_WEIGHTS if f"{action.name}_button" in shown]
+    if not actions:
+        return None
+    return rng.choices(actions, [ACTION_WEIGHTS[action] for action in actions])[0]
+
+
+def check_clicks(wave: List[Click]) -> List[str]:
+    """
+    A click that nothing else raced with should never be told the commission changed under it, nor fail
+    :param wave: Clicks that ran at the same time
+    :return: A description of each problem found
+    """
+    clicks_per_commission = Counter(click.commission_id for click in wave)
+    problems = []
+    for click in wave:
+        if click.outcome == "error":
+            problems.append(f"{click.action.name} on commission #{click.commission_id} failed")
+        elif click.outcome in ("conflict", "stale message") and clicks_per_commission[click.commission_id] == 1:
+            problems.append(f"{click.action.name} on commission #{click.commission_id} was refused as a "
+                            f"{click.outcome} with no other click on it")
+    return problems
+
+
+async def timed_click(env: BenchEnvironment, commission_id: int, message: FakeMessage, action: ButtonAction,
+                      member: FakeUser) -> Click:
+    start = perf_counter()
+    interaction = await click_button(env.fake, env.functions, message, action, member)
+    total_ms = (perf_counter() - start) * 1000
+    ack_ms = (interaction.acked_at - interaction.created_at_loop) * 1000 if interaction.acked_at else total_ms
+    return Click(commission_id, action, ack_ms, total_ms, classify(interaction.replies))
+
+
+async def settle(env: BenchEnvironment):
+    # Wait for follow-up work started by the clicks, like activity notices
+    while env.functions.background_tasks:
+        await asyncio.gather(*env.functions.background_tasks, return_exceptions=True)
+
+
+async def check_consistency(env: BenchEnvironment) -> List[str]:
+    """
+    Checks that every commission has exactly one live message, in the channel its state says it belongs in, showing
+    its current state, and that the DB's derived state agrees with itself
+    :return: A description of each problem found
+    """
+    f = env.functions
+    problems = []
+    commissions = await f.db.get_all_commissions()
+    status_messages = await f.db.get_status_messages()
+    expected_ids = {c["message_id"] for c in commissions} | {m["message_id"] for m in status_messages}
+    for channel_name in f.channels:
+        if channel_name == "bot-spam":
+            continue
+        for message_id in env.channel(channel_name).messages:
+            if message_id not in expected_ids:
+                problems.append(f"Message {message_id} in {channel_name} doesn't belong to any commission")
+    for commission in commissions:
+        name = "Commission #{}".format(commission["id"])
+        if commission["accepted"] and commission["assigned_to"] is None:
+            problems.append(f"{name} is accepted but not assigned to anyone")
+        if commission["invoiced"] and not commission["accepted"] or commission["paid"] and not commission["invoiced"]:
+            problems.append(f"{name} skipped a step: {utils.get_status(**commission).name}")
+        expected_channel = f.get_queue_channel_name(commission)
+        if commission["channel_name"] != expected_channel:
+            problems.append(f"{name} is recorded in {commission['channel_name']} but belongs in {expected_channel}")
+            continue
+        message = env.channel(expected_channel).messages.get(commission["message_id"])
+        if message is None:
+            problems.append(f"{name} has no live message in {expected_channel}")
+            continue
+        content, embed = utils.build_embed(**commission)
+        if message.content != content or not utils.embeds_match(message.embeds, embed):
+            problems.append(f"{name}'s message doesn't show its current state")
+        expected_buttons = [item.custom_id for item in
+                            EmbedButtonsView(f, commission["assigned_to"] is None, **commission).children]
+        buttons = [item.custom_id for item in message.view.children] if message.view else []
+        if buttons != expected_buttons:
+            problems.append(f"{name}'s message has buttons {buttons}, expected {expected_buttons}")
+    counts = await f.db.run(lambda db: db.cur.execute("""
+        SELECT status_key, COALESCE(assigned_to, ''), COUNT(*) FROM all_commissions GROUP BY 1, 2
+        EXCEPT SELECT status_key, assigned_to, count FROM commission_counts;
+    """).fetchall(), readonly=True)
+    if counts:
+        problems.append(f"commission_counts is out of date for {counts}")
+    return problems
+
+
+async def run(args: argparse.Namespace) -> StressResult:
+    async with BenchEnvironment(args.commissions, args.latency_ms / 1000, args.rate_limit, args.seed) as env:
+        f = env.functions
+        await f.update_commissions_information(randomize=False)
+        await f.send_commissions_status()
+        rng = random.Random(args.seed)
+        members = env.members + [FakeUser(env.fake, 5000 + i, f"Member {i}") for i in range(args.outsiders)]
+        ids = [c["id"] for c in await f.db.get_all_commissions()]
+        # A few commissions get most of the clicks, so clicks on the same commission overlap
+        hot = rng.sample(ids, max(1, len(ids) // 10))
+        clicks: List[Click] = []
+        problems: List[str] = []
+        start = perf_counter()
+        while len(clicks) < args.clicks:
+            # Every click in a wave is aimed at the message its commission was on when the wave started, and at a
+            # button shown on it, as if each member clicked what was on their screen at the same moment
+            wave = []
+            messages: Dict[int, FakeMessage] = {}
+            for _ in range(min(args.concurrency, args.clicks - len(clicks))):
+                commission_id = rng.choice(hot) if rng.random() < 0.8 else rng.choice(ids)
+                if commission_id not in messages:
+                    messages[commission_id] = await env.live_message(commission_id)
+                message = messages[commission_id]
+                action = pick_action(rng, message) if message else None
+                if action is not None:
+                    wave.append((commission_id, message, action, rng.choice(members)))
+            if not wave:
+                continue
+            wave_clicks = await asyncio.gather(*[timed_click(env, *click) for click in wave])
+            problems += check_clicks(wave_clicks)
+            clicks += wave_clicks
+        await settle(env)
+        seconds = perf_counter() - start
+        await f.send_commissions_status()
+        problems += await check_consistency(env)
+    return StressResult(clicks, seconds, len(members), env.fake.total_calls(), env.fake.rate_limited, problems)
+
+
+def print_report(result: StressResult, args: argparse.Namespace) -> bool:
+    """
+    :return: True if every click and the consistency check passed
+    """
+    clicks, seconds = result.clicks, result.seconds
+    acks = [click.ack_ms for click in clicks]
+    totals = [click.total_ms for click in clicks]
+    outcomes = Counter(click.outcome for click in clicks)
+    print(f"{len(clicks)} clicks in {seconds:.2f} s ({len(clicks) / seconds:.0f} clicks/s), from {result.members} "
+          f"members on {args.commissions} commissions, {args.concurrency} at a time")
+    print(f"Acknowledged: p50 {percentile(acks, 0.5):.1f} ms, p99 {percentile(acks, 0.99):.1f} ms")
+    print(f"Handled:      p50 {percentile(totals, 0.5):.1f} ms, p99 {percentile(totals, 0.99):.1f} ms, "
+          f"max {max(totals, default=0):.1f} ms")
+    print("Outcomes: " + ", ".join(f"{count} {outcome}" for outcome, count in outcomes.most_common()))
+    print(f"Discord API calls: {result.api_calls}, rate limited {result.rate_limits} times")
+    if result.problems:
+        print(f"Check FAILED with {len(result.problems)} problems:")
+        for problem in result.problems[:args.show_problems]:
+            print("  " + problem)
+        return False
+    print("Check passed: no click was refused without a competing click, and every commission has exactly one live "
+          "message matching the DB")
+    return True
+
+
+def main(argv=None) -> int:
+    from src.bench.benchmark import parse_rate_limit
+    parser = argparse.ArgumentParser(description="Replays concurrent button clicks from many members against a fake "
+                                                 "Discord, then checks the queues are consistent.")
+    parser.add_argument("--commissions", type=int, default=500)
+    parser.add_argument("--clicks", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50, help="How many clicks are in flight at once")
+    parser.add_argument("--outsiders", type=int, default=20, help="Members without a queue, who can't claim")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Added to every fake Discord API call")
+    parser.add_argument("--rate-limit", type=parse_rate_limit, default=None, metavar="REQUESTS/SECONDS",
+                        help="Per-channel rate limit of the fake Discord, e.g. 5/5")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--show-problems", type=int, default=20, help="How many problems to list")
+    parser.add_argument("--verbose", action="store_true", help="Show the bot's own output while it runs")
+    args = parser.parse_args(argv)
+
+    with open(os.devnull, "w") as devnull, redirect_stdout(sys.stdout if args.verbose else devnull):
+        result = asyncio.run(run(args))
+    return 0 if print_report(result, args) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
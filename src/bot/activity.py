@@ -0,0 +1,76 @@
+import asyncio
+import sys
+import traceback
+from typing import Awaitable, Callable, Iterable, List, Optional
+
+MAX_MESSAGE_LENGTH = 2000
+
+
+class ActivityLog:
+    """
+    Buffers activity notices for the bot-spam channel and posts them as digest messages, packed up to Discord's
+    message length limit. The buffer is flushed when it holds a full message's worth of text, or flush_seconds after
+    the first notice was buffered, whichever comes first. Event types listed in immediate_events skip the buffer.
+    """
+
+    def __init__(self, send: Callable[[str], Awaitable], flush_seconds: float=10,
+                 immediate_events: Iterable[str]=()):
+        self.send = send
+        self.flush_seconds = flush_seconds
+        self.immediate_events = set(immediate_events)
+        self.lines: List[str] = []
+        self.buffered_length = 0
+        self.flush_task: Optional[asyncio.Task] = None
+
+    async def add(self, event: str, text: str):
+        if event in self.immediate_events:
+            await self.send(text)
+            return
+        text = truncate(text)
+        if self.lines and self.buffered_length + 1 + len(text) > MAX_MESSAGE_LENGTH:
+            # The buffer already holds a full message
+            await self.flush()
+        self.buffered_length += len(text) + 1 if self.lines else len(text)
+        self.lines.append(text)
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(self.flush_seconds)
+        await self.flush()
+
+    async def flush(self):
+        lines, self.lines, self.buffered_length = self.lines, [], 0
+        if self.flush_task is not None and self.flush_task is not asyncio.current_task():
+            self.flush_task.cancel()
+        self.flush_task = None
+        for message in pack(lines):
+            try:
+                await self.send(message)
+            except Exception:
+                print("Failed to send activity digest.", file=sys.stderr)
+                traceback.print_exc(file=sys.stderr)
+
+
+def truncate(text: str) -> str:
+    if len(text) > MAX_MESSAGE_LENGTH:
+        return text[:MAX_MESSAGE_LENGTH - 3] + "..."
+    return text
+
+
+def pack(lines: List[str]) -> List[str]:
+    """
+    Joins lines into as few messages as possible, without splitting a line across messages
+    :param lines: Lines no longer than MAX_MESSAGE_LENGTH
+    :return:
+    """
+    messages = []
+    current = ""
+    for line in lines:
+        if current and len(current) + 1 + len(line) > MAX_MESSAGE_LENGTH:
+            messages.append(current)
+            current = ""
+        current = current + "\n" + line if current else line
+    if current:
+        messages.append(current)
+    return messages
@@ -1,49 +1,193 @@
-from typing import Optional
+import asyncio
+import sys
+import traceback
+from typing import Dict, Optional
 
-from discord.ext.commands import Context, Cog, command, Bot
+from discord.ext.commands import Context, Cog, command, Bot, is_owner, CheckFailure, CommandError, NotOwner
 from discord.ext.tasks import loop
 
+from src import metrics, utils
+from src.bot import functions
 from src.bot.functions import Functions
-from src.db.db import Db
+from src.db.db import close_database
 
 
 class Commands(Cog):
 
     def __init__(self, bot: Bot):
         self.bot = bot
-        self.f = Functions(bot)
+        # One Functions per guild in the config's "guilds" section, each with its own channels, database and
+        # spreadsheet. Without that section, a single one serves the top-level config, keyed by None.
+        self.functions: Dict[Optional[int], Functions] = {
+            guild_id: Functions(bot, guild_id) for guild_id in utils.GUILDS
+        } or {None: Functions(bot)}
+        self.initialized = False
+        self.metrics_server = None
+        # When the config file was last loaded, see config_watch_loop
+        self.config_mtime = functions.get_config_mtime()
+
+    def functions_for(self, context: Context) -> Optional[Functions]:
+        """
+        :return: The Functions of the guild the command was sent in, or None if the bot doesn't serve that guild
+        """
+        if None in self.functions:
+            return self.functions[None]
+        return self.functions.get(context.guild.id if context.guild else None)
+
+    async def cog_check(self, context: Context) -> bool:
+        # Commands sent in guilds that aren't in the config are ignored
+        return self.functions_for(context) is not None
+
+    async def cog_command_error(self, context: Context, error: CommandError):
+        if isinstance(error, NotOwner):
+            await context.send("Only the bot's owners can use that command.")
+        elif not isinstance(error, CheckFailure):
+            print(f"Command {context.command} failed.", file=sys.stderr)
+            traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
+
+    @staticmethod
+    async def run_for_guild(f: Functions, coroutine_fn, description: str):
+        # Guilds run independently, so one guild's failure is logged without stopping the others
+        try:
+            await coroutine_fn(f)
+        except Exception:
+            print(f"Failed to {description} for guild {f.guild_id}.", file=sys.stderr)
+            traceback.print_exc(file=sys.stderr)
+
+    async def run_for_all_guilds(self, coroutine_fn, description: str):
+        await asyncio.gather(*[self.run_for_guild(f, coroutine_fn, description) for f in self.functions.values()])
 
     async def init(self):
-        await self.f.init()
+        # on_ready fires again after every gateway reconnect, but the queues only need setting up once
+        if self.initialized:
+            print("Reconnected; skipping startup")
+            return
+        self.initialized = True
+        await self.run_for_all_guilds(Functions.init, "start up")
         self.update_loop.start()
+        self.metrics_server = await metrics.serve(functions.METRICS_PORT)
+        if functions.CONFIG_WATCH_SECONDS > 0:
+            self.config_watch_loop.change_interval(seconds=functions.CONFIG_WATCH_SECONDS)
+            self.config_watch_loop.start()
+
+    def cog_unload(self):
+        self.update_loop.cancel()
+        self.config_watch_loop.cancel()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        for f in self.functions.values():
+            f.sheets.close()
+            f.db.close()
+            close_database(f.db.filename)
 
     @loop(seconds=60)
     async def update_loop(self):
-        await self.f.update_commissions_information(False)
+        async def update(f: Functions):
+            await f.update_commissions_information(False)
+            await f.archive_finished_commissions()
+
+        await self.run_for_all_guilds(update, "update commissions")
 
     @update_loop.before_loop
     async def update_loop_before(self):
         await self.bot.wait_until_ready()
 
+    @loop(seconds=10)
+    async def config_watch_loop(self):
+        if functions.get_config_mtime() == self.config_mtime:
+            return
+        print("Config file changed. Reloading...")
+        try:
+            print(await self.reload_all_config())
+        except Exception:
+            print("Failed to reload the config. Keeping the old one.", file=sys.stderr)
+            traceback.print_exc(file=sys.stderr)
+
+    async def reload_all_config(self) -> str:
+        """
+        Re-reads the config file and applies it to every guild. Guilds added to or removed from the config need a
+        restart.
+        :return: A summary of the new config
+        """
+        self.config_mtime = functions.get_config_mtime()
+        functions.reload_config_file()
+        summaries = await asyncio.gather(*[f.apply_config() for f in self.functions.values()])
+        if None in self.functions:
+            summary = "Reloaded config: " + summaries[0]
+        else:
+            summary = "Reloaded config:\n" + "\n".join(f"Guild {guild_id}: {guild_summary}"
+                                                      for guild_id, guild_summary in zip(self.functions, summaries))
+        new_guilds = set(utils.GUILDS) - set(self.functions)
+        if new_guilds:
+            summary += "\nNew guilds need a restart: {}".format(", ".join(map(str, sorted(new_guilds))))
+        return summary
+
     @command(name="update")
     async def update(self, context: Context, randomize=False):
-        await self.f.update_commissions_information(randomize)
+        await self.functions_for(context).update_commissions_information(randomize)
+
+    @command(name="rescan")
+    @is_owner()
+    async def rescan(self, context: Context, randomize=False):
+        # Ignores the stored sheet watermarks and re-reads every form response, to repair missed rows
+        await self.functions_for(context).update_commissions_information(randomize, full_rescan=True)
 
     @command(name="cleanup")
     async def cleanup(self, context: Context, queue: Optional[str]=None):
-        await self.f.cleanup_channels(queue)
+        await self.functions_for(context).cleanup_channels(queue)
 
     @command(name="refresh")
     async def refresh(self, context: Context, queue: Optional[str]=None):
-        await self.f.cleanup_and_resend_messages(False, queue)
+        await self.functions_for(context).cleanup_and_resend_messages(False, queue)
+
+    @command(name="reconcile")
+    @is_owner()
+    async def reconcile(self, context: Context):
+        await self.functions_for(context).reconcile_messages()
+
+    @command(name="archive")
+    @is_owner()
+    async def archive(self, context: Context):
+        count = await self.functions_for(context).archive_finished_commissions()
+        await context.send(f"Archived {count} finished commissions")
+
+    @command(name="reloadconfig")
+    @is_owner()
+    async def reload_config(self, context: Context):
+        try:
+            await context.send(await self.reload_all_config())
+        except Exception as e:
+            traceback.print_exc(file=sys.stderr)
+            await context.send(f"Couldn't reload the config, so the old one is still in use: {e}")
 
     @command(name="shuffle")
     async def shuffle(self, context: Context, queue: Optional[str]=None):
-        await self.f.cleanup_and_resend_messages(True, queue)
+        await self.functions_for(context).cleanup_and_resend_messages(True, queue)
+
+    @command(name="queues")
+    @is_owner()
+    async def queues(self, context: Context):
+        row_fmt = "{}: {queued} queued, {completed} sent, wait p50 {wait_p50_ms:.0f} ms, max {wait_max_ms:.0f} ms"
+        stats_by_priority = self.functions_for(context).outbound.stats()
+        lines = [row_fmt.format(priority, **stats) for priority, stats in stats_by_priority.items()]
+        await context.send("\n".join(lines))
+
+    @command(name="metrics")
+    @is_owner()
+    async def show_metrics(self, context: Context):
+        # Code blocks are cut at Discord's message limit, so send the summary in pieces
+        lines = metrics.summarize().splitlines()
+        chunk = []
+        for line in lines:
+            if chunk and sum(len(l) + 1 for l in chunk) + len(line) > 1900:
+                await context.send("```\n" + "\n".join(chunk) + "\n```")
+                chunk = []
+            chunk.append(line[:1900])
+        await context.send("```\n" + "\n".join(chunk) + "\n```")
 
     @command(name="test")
     async def test(self, context: Context):
-        await self.f.cleanup_channels()
-        with Db() as db:
-            commissions = list(db.get_all_commissions())
-            await self.f.send_commission_embed(db, commissions[1], set_counter=0)
+        f = self.functions_for(context)
+        await f.cleanup_channels()
+        commissions = await f.db.get_all_commissions()
+        await f.send_commission_embed(commissions[1], set_counter=0)
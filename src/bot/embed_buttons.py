@@ -1,9 +1,15 @@
+import sys
+import traceback
+from datetime import datetime, timezone
 from enum import Enum
+from time import perf_counter
 from typing import Dict
 
 import discord
 
-from src.utils import build_embed
+from src import metrics
+from src.db.db import TransitionConflict
+from src.utils import BotError, build_embed
 
 
 class ButtonAction(Enum):
@@ -31,55 +37,117 @@ class EmbedButton(discord.ui.Button['EmbedButtonsRow']):
     async def callback(self, interaction: discord.Interaction):
         print("Button clicked: {} {!r} {}".format(self.action, interaction.message.content, interaction.user.name))
         view: EmbedButtonsView = self.view
-        if view.processing_callback:
-            print(f"{self.action} was clicked while its view was processing another click. Ignoring this click.")
-            await interaction.user.send("Whoops! Someone else clicked a button on that commission right before "
-                                        "you did. Please try again in a few moments.", delete_after=60)
-            return
-        view.processing_callback = True
+        functions = view.functions_obj
+        start = perf_counter()
+        waited_ms = 0
+        syncing = functions.syncing
+        message_id = interaction.message.id
+        # Acknowledge the click before anything else, so Discord's 3 second deadline never depends on the work below.
+        # Interaction responses aren't rate limited per channel, so they skip the outbound queue.
+        await interaction.response.defer()
+        ack_ms = (perf_counter() - start) * 1000
+        metrics.INTERACTION_ACK_SECONDS.observe(ack_ms / 1000)
         try:
-            functions = view.functions_obj
-            message_id = interaction.message.id
-            if self.action == ButtonAction.Reject:
-                commission = await functions.reject_commission(interaction.user, message_id)
-            elif self.action == ButtonAction.Claim:
-                commission = await functions.claim_commission(interaction.user, message_id)
-            else:
-                if self.action == ButtonAction.Accept:
-                    coroutine = functions.accept_commission(interaction.user, message_id)
-                    commission = await coroutine if coroutine else None
-                elif self.action == ButtonAction.Show:
-                    commission = await functions.show_commission(message_id)
-                elif self.action == ButtonAction.Hide:
-                    commission = await functions.hide_commission(message_id)
-                elif self.action == ButtonAction.Invoiced:
-                    commission = await functions.invoice_commission(message_id)
-                elif self.action == ButtonAction.Paid:
-                    commission = await functions.pay_commission(message_id)
-                elif self.action == ButtonAction.Done:
-                    commission = await functions.finish_commission(message_id)
-                else:
-                    raise ValueError(self.action)
-                if commission:
-                    await self.edit_message(interaction, commission)
-            if self.action not in [ButtonAction.Show, ButtonAction.Hide]:
-                # Send update message
-                await view.functions_obj.send_status_update(
-                    self.action,
-                    commission["id"],
-                    interaction.user.name,
-                    interaction.channel.name
-                )
-                # Update commissions status message
-                await view.functions_obj.send_commissions_status()
+            commission = await functions.db.get_commission_by_message_id(message_id)
+            if commission is None:
+                await self.reject_stale_click(interaction)
+                return
+            # Clicks on the same commission are queued and run one at a time, each against the state the previous
+            # one left behind. Clicks on different commissions don't wait for each other.
+            async with functions.commission_locks.hold(commission["id"]):
+                waited_ms = (perf_counter() - start) * 1000 - ack_ms
+                commission = await functions.db.get_commission_by_id(commission["id"])
+                if commission["message_id"] != message_id:
+                    # An earlier click replaced this message, e.g. by claiming the commission
+                    await self.reject_stale_click(interaction)
+                    return
+                await self.run_action(interaction, commission)
+        except BotError as e:
+            await self.reply_privately(interaction, str(e))
+        except TransitionConflict as e:
+            # Something outside the buttons changed the commission between the read and the write
+            print(e)
+            await self.reply_privately(interaction, "That commission changed right before you clicked. "
+                                                    "Please check it and try again.")
+        except Exception:
+            print(f"Failed to handle {self.action}.", file=sys.stderr)
+            traceback.print_exc(file=sys.stderr)
+            await self.reply_privately(interaction, "Something went wrong handling that click. Please try again.")
         finally:
-            view.processing_callback = False
+            # Time until the click was acknowledged, time spent handling it, and time from the click until handling
+            # finished
+            handled_ms = (perf_counter() - start) * 1000
+            metrics.INTERACTION_SECONDS.observe(handled_ms / 1000, action=self.action.name)
+            total_ms = (datetime.now(timezone.utc) - interaction.created_at).total_seconds() * 1000
+            print("Handled {} in {:.0f} ms, acknowledged after {:.0f} ms, {:.0f} ms queued ({:.0f} ms after click){}"
+                  .format(self.action, handled_ms, ack_ms, waited_ms, total_ms,
+                          ", during a sheet sync" if syncing else ""))
 
-    async def edit_message(self, interaction: discord.Interaction, commission: dict):
-        content, embed = build_embed(**commission)
+    async def run_action(self, interaction: discord.Interaction, commission: dict):
+        """
+        :param interaction:
+        :param commission: The commission as it is now, read while holding its lock
+        """
         view: EmbedButtonsView = self.view
-        new_view = EmbedButtonsView(view.functions_obj, view.claimable, **commission)
-        await interaction.response.edit_message(content=content, embed=embed, view=new_view)
+        functions = view.functions_obj
+        if self.action == ButtonAction.Reject:
+            commission = await functions.reject_commission(interaction.user, commission)
+        elif self.action == ButtonAction.Claim:
+            commission = await functions.claim_commission(interaction.user, commission)
+        elif self.action == ButtonAction.Accept:
+            commission = await functions.accept_commission(interaction.user, commission)
+        elif self.action == ButtonAction.Show:
+            commission = await functions.show_commission(commission)
+        elif self.action == ButtonAction.Hide:
+            commission = await functions.hide_commission(commission)
+        elif self.action == ButtonAction.Invoiced:
+            commission = await functions.invoice_commission(commission)
+        elif self.action == ButtonAction.Paid:
+            commission = await functions.pay_commission(commission)
+        elif self.action == ButtonAction.Done:
+            commission = await functions.finish_commission(commission)
+        else:
+            raise ValueError(self.action)
+        if not commission:
+            return
+        # Claims and rejects usually send the commission to another queue. The clicked message is updated in place
+        # first, without buttons, so the click gets its feedback before the move.
+        moving = functions.get_queue_channel_name(commission) != commission["channel_name"]
+        await self.edit_message(interaction, commission, buttons=not moving)
+        if moving:
+            # Still holding the commission's lock, so the next click on it waits for the new message
+            await functions.move_commission(commission)
+        if self.action not in [ButtonAction.Show, ButtonAction.Hide]:
+            # Send update message
+            functions.run_in_background(functions.send_status_update(
+                self.action,
+                commission["id"],
+                interaction.user.name,
+                interaction.channel.name
+            ))
+            # Update commissions status message
+            functions.request_commissions_status()
+
+    async def reject_stale_click(self, interaction: discord.Interaction):
+        print(f"{self.action} was clicked on a message that has since been replaced. Ignoring this click.")
+        await self.reply_privately(interaction, "Someone else changed that commission right before you clicked, so "
+                                                "its buttons have moved to a new message. Please try again there.")
+
+    @staticmethod
+    async def reply_privately(interaction: discord.Interaction, text: str):
+        # Only the user who clicked can see this
+        await interaction.followup.send(text, ephemeral=True)
+
+    async def edit_message(self, interaction: discord.Interaction, commission: dict, buttons=True):
+        content, embed = build_embed(**commission)
+        functions = self.view.functions_obj
+        new_view = EmbedButtonsView(functions, commission["assigned_to"] is None, **commission) if buttons else None
+        if new_view and functions.render_unchanged(interaction.message.id, content, embed, new_view):
+            # Nothing visible would change, and the click has already been acknowledged
+            return
+        await interaction.edit_original_response(content=content, embed=embed, view=new_view)
+        if new_view:
+            functions.remember_render(interaction.message.id, content, embed, new_view)
 
 
 class EmbedButtonsView(discord.ui.View):
@@ -87,7 +155,6 @@ class EmbedButtonsView(discord.ui.View):
     functions_obj = None
     claimable = None
     buttons: Dict[ButtonAction, EmbedButton] = {}
-    processing_callback = False
 
     def __init__(self, functions_obj: "Functions", claimable: bool, accepted: bool, hidden: bool, invoiced: bool,
                  paid: bool, finished: bool, **kwargs):
@@ -105,13 +172,13 @@ class EmbedButtonsView(discord.ui.View):
                         self.add_button(ButtonAction.Accept)
                     self.add_button(ButtonAction.Reject)
             self.add_button(ButtonAction.Hide)
-            if not claimable and accepted:
+            # A finished commission that's shown again can't be invoiced or paid any more; see TRANSITIONS
+            if not claimable and accepted and not finished:
                 if not invoiced:
                     self.add_button(ButtonAction.Invoiced)
                 elif not paid:
                     self.add_button(ButtonAction.Paid)
-                if not finished:
-                    self.add_button(ButtonAction.Done)
+                self.add_button(ButtonAction.Done)
 
     def add_button(self, button_action: ButtonAction):
         button_object = EmbedButton(button_action)
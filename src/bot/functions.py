@@ -1,45 +1,183 @@
+import asyncio
+import os
 import sys
 import traceback
+from collections import OrderedDict
+from datetime import timedelta
+from functools import partial
 from random import shuffle
-from typing import Dict, Optional, List
+from typing import Awaitable, Callable, Dict, Optional, List, Set, Tuple
 
-from discord import Message, Emoji, Embed, Member
+from discord import Message, Emoji, Embed, Forbidden, Member, NotFound, Object, TextChannel
 from discord.ext.commands import Bot
 from discord.ui import View
-from discord.utils import get as discord_get
-from googleapiclient.discovery import build
-
-from src import utils
+from discord.utils import get as discord_get, snowflake_time, utcnow
+from googleapiclient.errors import HttpError
+from src import metrics, utils
+from src.bot.activity import ActivityLog
 from src.bot.embed_buttons import EmbedButtonsView
-from src.db.db import Db
+from src.bot.locks import LockRegistry
+from src.bot.scheduler import OutboundScheduler, Priority
+from src.bot.sheets import SheetsClient, FormSource, load_form_sources
+from src.db.async_db import AsyncDb
+from src.db.db import Db, guild_db_file, open_database
 
 GOOGLE_SHEETS_DEVELOPER_KEY = None
 SHEET_ID = None
+FORM_SOURCES: List[FormSource] = []
+SHEETS_TIMEOUT = 30
+STATUS_REFRESH_SECONDS = 5
+ACTIVITY_FLUSH_SECONDS = 10
+ACTIVITY_IMMEDIATE_EVENTS: List[str] = []
+# How often to check the config file for changes, or 0 to only reload it on command
+CONFIG_WATCH_SECONDS = 0
+# The local port to serve Prometheus metrics on, or 0 to not serve them
+METRICS_PORT = 0
+# How long a finished commission stays in the live table before it's archived, or None to never archive
+ARCHIVE_AFTER_DAYS = 7
+LAST_RENDERS_SIZE = 4096
+# Discord refuses to bulk delete messages older than this
+BULK_DELETE_MAX_AGE = timedelta(days=14)
+# The most messages Discord returns for one channel history request
+HISTORY_PAGE_SIZE = 100
+
+
+def get_config_mtime() -> Optional[float]:
+    try:
+        return os.stat(utils.CONFIG_PATH).st_mtime
+    except OSError:
+        return None
+
+
+def reload_config_file() -> dict:
+    """
+    Re-reads the config file for every guild at once. Each guild's Functions then picks up its part with apply_config.
+    Settings read at startup, like the token, prefix and spreadsheet IDs, still need a restart.
+    :return: The whole config
+    """
+    global FORM_SOURCES
+    j = utils.load_config()
+    FORM_SOURCES = load_form_sources(j)
+    return j
 
 
 class Functions:
-    channels = {}
-    emoji_cache = {}
+    """
+    Runs the commission queues of one guild: its channels, its database and its spreadsheet. With guild_id None, it
+    uses the top-level config and main database, and finds its channels in any guild the bot is in.
+    """
 
-    def __init__(self, bot: Bot):
-        with Db() as db:
-            db.check_version()
+    def __init__(self, bot: Bot, guild_id: Optional[int]=None):
+        self.guild_id = guild_id
+        self.config = utils.get_guild_config(guild_id)
+        self.form_sources = self.get_form_sources()
+        # Channel and emoji IDs by name, in this guild only
+        self.channels: Dict[str, int] = {}
+        self.emoji_cache: Dict[str, Emoji] = {}
+        db_file = None if guild_id is None else guild_db_file(guild_id)
+        # Opens the long-lived DB connections and checks the schema version once, at startup
+        open_database(db_file)
+        # All DB work from coroutines goes through this, so it never blocks the event loop
+        self.db = AsyncDb(db_file)
+        self.db.start()
         self.bot = bot
+        if getattr(bot, "http", None) is not None:
+            metrics.instrument_http(bot.http)
+        metrics.count_rate_limits()
+        # What each message was last sent or edited with, to skip edits that wouldn't change anything
+        self.last_renders: "OrderedDict[int, tuple]" = OrderedDict()
+        # Every outbound Discord call goes through this, so channels run in parallel and clicks jump the queue
+        self.outbound = OutboundScheduler()
+        self.sheets = SheetsClient(GOOGLE_SHEETS_DEVELOPER_KEY, self.config.section.get("spreadsheet_id", SHEET_ID),
+                                   SHEETS_TIMEOUT)
+        # Serializes button clicks on the same commission, keyed by commission ID
+        self.commission_locks = LockRegistry()
+        # Follow-up work started by run_in_background, kept here so it isn't garbage collected mid-run
+        self.background_tasks: Set[asyncio.Task] = set()
+        # Set while a sheet fetch is in flight, so interaction latency during a sync can be told apart
+        self.syncing = False
+        # Pending status refresh, see request_commissions_status
+        self.status_task: Optional[asyncio.Task] = None
+        self.status_dirty = False
+        # Collects bot-spam notices into digest messages
+        self.activity = ActivityLog(
+            lambda text: self.send_to_channel("bot-spam", text, priority=Priority.Bulk),
+            ACTIVITY_FLUSH_SECONDS,
+            ACTIVITY_IMMEDIATE_EVENTS
+        )
+
+    @staticmethod
+    def render_fingerprint(content: str, embed: Embed, view: View) -> tuple:
+        return content, embed.to_dict(), tuple(item.custom_id for item in view.children)
+
+    def render_unchanged(self, message_id: int, content: str, embed: Embed, view: View) -> bool:
+        """
+        :return: True if the message was last sent or edited with exactly this content, embed and set of buttons
+        """
+        return self.last_renders.get(message_id) == self.render_fingerprint(content, embed, view)
+
+    def remember_render(self, message_id: int, content: str, embed: Embed, view: View):
+        self.last_renders[message_id] = self.render_fingerprint(content, embed, view)
+        self.last_renders.move_to_end(message_id)
+        if len(self.last_renders) > LAST_RENDERS_SIZE:
+            self.last_renders.popitem(last=False)
 
     async def init(self):
+        # Queue channels need a counter row before anything is sent to them
+        await self.db.add_channels(list(self.config.channels))
         self.save_channels()
-        await self.cleanup_and_resend_messages()
+        await self.reconcile_messages()
+
+    def get_guild_channels(self):
+        if self.guild_id is None:
+            return self.bot.get_all_channels()
+        guild = self.bot.get_guild(self.guild_id)
+        return guild.channels if guild else []
+
+    def get_form_sources(self) -> List[FormSource]:
+        # Guilds without form_sources of their own use the top-level ones
+        if "form_sources" in self.config.section:
+            return load_form_sources(self.config.section)
+        return FORM_SOURCES
 
     def save_channels(self):
-        channel_list = self.bot.get_all_channels()
-        for channel in channel_list:
-            if channel.name in utils.CHANNELS:
-                self.channels[channel.name] = channel.id
+        # Build the whole map before swapping it in, and stop walking the channels once every one has been found
+        wanted = set(self.config.channels)
+        channels = {}
+        for channel in self.get_guild_channels():
+            if channel.name in wanted and channel.name not in channels:
+                channels[channel.name] = channel.id
+                if len(channels) == len(wanted):
+                    break
+        self.channels = channels
         print(self.channels)
+        if len(channels) < len(wanted):
+            print("Channels in the config that weren't found: {}".format(", ".join(sorted(wanted - set(channels)))))
+
+    async def apply_config(self) -> str:
+        """
+        Switches this guild to the config last loaded by reload_config_file, without restarting the bot or
+        reconnecting to Discord. Channel, artist and user changes apply right away, and the messages of any commission
+        whose queue channel changed are moved.
+        :return: A summary of the guild's new config
+        """
+        config = utils.get_guild_config(self.guild_id)
+        if config is None:
+            return "no longer in the config, so its old config is kept until the bot restarts"
+        old_channels = self.config.channels
+        self.config = config
+        self.form_sources = self.get_form_sources()
+        # New queue channels need a counter row before anything is sent to them
+        await self.db.add_channels(list(config.channels))
+        self.save_channels()
+        if config.channels != old_channels:
+            await self.reconcile_messages()
+        return f"{len(config.channels)} channels, {len(config.users)} users"
 
     def get_custom_emoji(self, emoji_name: str) -> Emoji:
         if emoji_name not in self.emoji_cache:
-            for guild in self.bot.guilds:
+            guilds = self.bot.guilds if self.guild_id is None else [self.bot.get_guild(self.guild_id)]
+            for guild in filter(None, guilds):
                 emoji = discord_get(guild.emojis, name=emoji_name)
                 if emoji:
                     self.emoji_cache[emoji_name] = emoji
@@ -50,21 +188,118 @@ class Functions:
 
     async def cleanup_and_resend_messages(self, randomize=True, queue=None):
         channels_list = [queue] if queue else list(self.channels.keys())
-        with Db() as db:
-            for channel_name in channels_list:
-                await self.cleanup_channels(channel_name)
-                print(f"Resending commissions for {channel_name}...")
-                commissions = list(db.get_all_commissions_for_queue(channel_name) if channel_name
-                                   else db.get_all_commissions())
-                if randomize:
-                    shuffle(commissions)
-                for commission in commissions:
-                    # print(f"Sending {commission}")
-                    if commission["finished"]:
-                        continue
-                    await self.send_commission_embed(db, commission, set_counter=False)
-                    # sleep(0.750)
-        await self.send_commissions_status()
+        # Each channel is cleaned and refilled independently, so they can all go at once
+        await asyncio.gather(*[self.cleanup_and_resend_channel(channel_name, randomize)
+                               for channel_name in channels_list])
+        self.request_commissions_status()
+
+    async def cleanup_and_resend_channel(self, channel_name: str, randomize=True):
+        await self.cleanup_channels(channel_name)
+        print(f"Resending commissions for {channel_name}...")
+        commissions = await (self.db.get_active_commissions_for_queue(channel_name) if channel_name
+                             else self.db.get_active_commissions())
+        if randomize:
+            shuffle(commissions)
+        for commission in commissions:
+            # print(f"Sending {commission}")
+            await self.send_commission_embed(commission, set_counter=False, priority=Priority.Bulk)
+            # sleep(0.750)
+
+    async def reconcile_messages(self):
+        """
+        Brings the queue channels in line with the DB by only sending, editing or deleting the messages that differ,
+        instead of wiping and re-sending every commission. Messages that are kept get their buttons re-attached.
+        """
+        commissions, status_messages = await self.db.batch(("get_active_commissions",), ("get_status_messages",))
+        # Every message the bot has in the queue channels, by ID
+        live: Dict[int, Tuple[str, Message]] = {}
+        channel_names = [channel_name for channel_name in self.channels if channel_name != "bot-spam"]
+        histories = await asyncio.gather(*[self.get_bot_messages(channel_name) for channel_name in channel_names])
+        for channel_name, messages in zip(channel_names, histories):
+            for message in messages:
+                live[message.id] = (channel_name, message)
+        keep = {status_message["message_id"] for status_message in status_messages}
+        # Work out every channel's changes first, then apply them with the channels in parallel
+        changes: Dict[str, List[Callable[[], Awaitable]]] = {}
+        sent = edited = 0
+        for commission in commissions:
+            channel_name, message = live.get(commission["message_id"], (None, None))
+            if message is None or channel_name != self.get_queue_channel_name(commission):
+                changes.setdefault(self.get_queue_channel_name(commission), []).append(
+                    partial(self.send_commission_embed, commission, set_counter=False, priority=Priority.Bulk)
+                )
+                sent += 1
+                continue
+            keep.add(message.id)
+            content, embed = utils.build_embed(**commission)
+            view = EmbedButtonsView(self, commission["assigned_to"] is None, **commission)
+            if message.content != content or not utils.embeds_match(message.embeds, embed):
+                changes.setdefault(channel_name, []).append(partial(
+                    self.outbound.submit, message.channel.id, Priority.Bulk,
+                    partial(message.edit, content=content, embed=embed, view=view)
+                ))
+                edited += 1
+            else:
+                self.bot.add_view(view, message_id=message.id)
+            self.remember_render(message.id, content, embed, view)
+        stale: Dict[str, List[int]] = {}
+        for message_id, (channel_name, _) in live.items():
+            if message_id not in keep:
+                stale.setdefault(channel_name, []).append(message_id)
+        for channel_name, message_ids in stale.items():
+            changes.setdefault(channel_name, []).append(partial(self.purge_channel_messages, channel_name, message_ids))
+        await asyncio.gather(*[self.apply_in_order(channel_changes) for channel_changes in changes.values()])
+        print(f"Reconciled messages: {sent} sent, {edited} edited, {sum(map(len, stale.values()))} deleted")
+        self.request_commissions_status()
+
+    async def archive_finished_commissions(self) -> int:
+        """
+        Moves the commissions finished more than ARCHIVE_AFTER_DAYS ago into the archive, and deletes their messages
+        :return: How many commissions were archived
+        """
+        if ARCHIVE_AFTER_DAYS is None:
+            return 0
+        archived = await self.db.archive_finished_commissions(ARCHIVE_AFTER_DAYS * 24 * 60 * 60)
+        by_channel: Dict[str, List[int]] = {}
+        for commission in archived:
+            if commission["message_id"] is not None and commission["channel_name"] in self.channels:
+                by_channel.setdefault(commission["channel_name"], []).append(commission["message_id"])
+        await asyncio.gather(*[self.purge_messages(self.bot.get_channel(self.channels[channel_name]), message_ids)
+                               for channel_name, message_ids in by_channel.items()])
+        if archived:
+            print(f"Archived {len(archived)} finished commissions")
+        return len(archived)
+
+    async def get_bot_messages(self, channel_name: str) -> List[Message]:
+        """
+        Reads the channel's history one page at a time. Each page is its own Bulk call, so clicks and edits on the
+        channel don't wait for the whole history to be read.
+        :param channel_name:
+        :return: Every message the bot has sent to the channel, newest first
+        """
+        channel = self.bot.get_channel(self.channels[channel_name])
+        messages = []
+        before = None
+        while True:
+            page = await self.outbound.submit(channel.id, Priority.Bulk,
+                                              partial(self.read_history_page, channel, before))
+            messages += [message for message in page if message.author.id == self.bot.user.id]
+            if len(page) < HISTORY_PAGE_SIZE:
+                return messages
+            before = Object(id=page[-1].id)
+
+    @staticmethod
+    async def read_history_page(channel: TextChannel, before: Optional[Object]) -> List[Message]:
+        return [message async for message in channel.history(limit=HISTORY_PAGE_SIZE, before=before)]
+
+    @staticmethod
+    async def apply_in_order(changes: List[Callable[[], Awaitable]]):
+        for change in changes:
+            await change()
+
+    async def purge_channel_messages(self, channel_name: str, message_ids: List[int]):
+        await self.purge_messages(self.bot.get_channel(self.channels[channel_name]), message_ids)
+        await self.db.forget_message_ids(message_ids)
 
     async def cleanup_channels(self, queue: str=None):
         for channel_name, channel_id in self.channels.items():
@@ -74,21 +309,53 @@ class Functions:
                 continue
             print(f"Cleaning {channel_name}...")
             channel = self.bot.get_channel(channel_id)
-            async for message in channel.history():
-                if message.author.name == "CommissionQueueBot":
-                    await message.delete()
+            message_ids = await self.db.get_tracked_message_ids(channel_name)
+            await self.purge_messages(channel, message_ids)
+            await self.db.clear_message_ids(channel_name)
+
+    async def purge_messages(self, channel: TextChannel, message_ids: List[int]):
+        """
+        Deletes the given messages from the channel, using bulk deletes of up to 100 messages for the ones young enough
+        for Discord to allow it, and single deletes for the rest. Bulk deletes need the Manage Messages permission, so
+        without it every message is deleted on its own.
+        :param channel:
+        :param message_ids:
+        """
+        # Leave some margin, so a message doesn't age past the limit between this check and the request
+        cutoff = utcnow() - BULK_DELETE_MAX_AGE + timedelta(minutes=5)
+        recent_ids = [i for i in message_ids if snowflake_time(i) > cutoff]
+        single_ids = [i for i in message_ids if snowflake_time(i) <= cutoff]
+        for i in range(0, len(recent_ids), 100):
+            chunk = [Object(id=message_id) for message_id in recent_ids[i:i + 100]]
+            try:
+                await self.outbound.submit(channel.id, Priority.Bulk, partial(channel.delete_messages, chunk))
+            except NotFound:
+                # Only raised for single deletes, when the message is already gone
+                pass
+            except Forbidden:
+                # The bot can always delete its own messages one at a time
+                print(f"Missing the Manage Messages permission in {channel.name}. Deleting messages one at a time.")
+                single_ids = recent_ids[i:] + single_ids
+                break
+        for message_id in single_ids:
+            try:
+                await self.outbound.submit(channel.id, Priority.Bulk, channel.get_partial_message(message_id).delete)
+            except NotFound:
+                pass
 
     async def send_to_channel(self, channel_name: str, content: str, embed: Embed=None,
-                              view: Optional[View]=None) -> Message:
+                              view: Optional[View]=None, priority=Priority.Edit) -> Message:
         channel = self.bot.get_channel(self.channels[channel_name])
         if embed and view:
-            return await channel.send(content=content, embed=embed, view=view)
+            return await self.outbound.submit(
+                channel.id, priority, partial(channel.send, content=content, embed=embed, view=view)
+            )
         else:
-            return await channel.send(content=content)
+            return await self.outbound.submit(channel.id, priority, partial(channel.send, content=content))
 
     async def send_status_update(self, action_name: str, commission_id: id, user_name: str, channel_name: str):
-        await self.send_to_channel(
-            "bot-spam",
+        await self.activity.add(
+            getattr(action_name, "name", str(action_name)),
             "Commission #{} has been {} by {} in channel {}".format(
                 commission_id,
                 action_name,
@@ -97,146 +364,260 @@ class Functions:
             )
         )
 
+    def request_commissions_status(self):
+        """
+        Schedules a refresh of the commissions status message. Requests made while one is already scheduled are
+        coalesced into it, so the message is edited at most once every STATUS_REFRESH_SECONDS.
+        """
+        self.status_dirty = True
+        if self.status_task is None or self.status_task.done():
+            self.status_task = asyncio.create_task(self.refresh_commissions_status())
+
+    async def refresh_commissions_status(self):
+        # Keep going while requests come in during the wait or the refresh itself
+        while self.status_dirty:
+            await asyncio.sleep(STATUS_REFRESH_SECONDS)
+            self.status_dirty = False
+            await self.send_commissions_status()
+
     async def send_commissions_status(self):
+        """
+        Brings the status board up to date. It's spread over as many messages as it needs, and only the pages whose
+        text changed are edited.
+        """
+        with metrics.STATUS_REFRESH_SECONDS.time():
+            await self.update_status_pages()
+
+    async def update_status_pages(self):
         try:
-            with Db() as db:
-                commissions = list(db.get_all_commissions())
-            content = utils.build_commissions_status_page(commissions)
-            channel = self.bot.get_channel(self.channels[utils.get_channel_name("!Status")])
-            async for message in channel.history():
-                if message.author.name == "CommissionQueueBot" and message.content.startswith("Commissions status:"):
-                    await message.edit(content=content)
-                    break
-            else:
-                await channel.send(content=content)
+            commissions, status_counts, status_messages = await self.db.batch(
+                ("get_active_commissions",), ("get_status_counts",), ("get_status_messages",)
+            )
+            channel_name = utils.get_channel_name("!Status", self.config.lookups)
+            channel = self.bot.get_channel(self.channels[channel_name])
+            # Pages that were sent to another channel can't be edited, so they're replaced
+            existing = {m["page"]: m for m in status_messages if m["channel_name"] == channel_name}
+            if not status_messages:
+                # Nothing remembered yet, so look for a status message sent before they were tracked
+                for message in await self.get_bot_messages(channel_name):
+                    if message.content.startswith("Commissions status:"):
+                        existing[0] = {"message_id": message.id, "content": message.content, "first_id": 0}
+                        break
+            first_ids = [existing[page]["first_id"] for page in sorted(existing)]
+            finished_commissions = status_counts.get(utils.Status.Finished.value.sort_key, 0)
+            pages, first_ids = utils.build_commissions_status_pages(commissions, finished_commissions, first_ids)
+            for page, (content, first_id) in enumerate(zip(pages, first_ids)):
+                status_message = existing.get(page)
+                if status_message and status_message["content"] == content:
+                    if status_message["first_id"] != first_id:
+                        await self.db.set_status_message(page, channel_name, status_message["message_id"], content,
+                                                         first_id)
+                    continue
+                message_id = None
+                if status_message:
+                    try:
+                        await self.outbound.submit(channel.id, Priority.Edit, partial(
+                            channel.get_partial_message(status_message["message_id"]).edit, content=content
+                        ))
+                        message_id = status_message["message_id"]
+                    except NotFound:
+                        print(f"Status message page {page} was deleted. Sending a new one.")
+                if message_id is None:
+                    message_id = (await self.send_to_channel(channel_name, content)).id
+                await self.db.set_status_message(page, channel_name, message_id, content, first_id)
+            # Remove pages left over from a longer board, or from another channel
+            extra_pages = [m for m in status_messages if m["page"] >= len(pages) or m["channel_name"] != channel_name]
+            for status_message in extra_pages:
+                if status_message["message_id"] is not None and status_message["channel_name"] in self.channels:
+                    await self.purge_messages(self.bot.get_channel(self.channels[status_message["channel_name"]]),
+                                              [status_message["message_id"]])
+                if status_message["page"] >= len(pages):
+                    await self.db.delete_status_message(status_message["page"])
         except Exception:
             print("Failed to generate commissions status page.", file=sys.stderr)
             traceback.print_exc(file=sys.stderr)
 
-    async def delete_message(self, channel_name: str, message_id: int):
+    async def delete_message(self, channel_name: str, message_id: int, priority=Priority.Edit):
         channel = self.bot.get_channel(self.channels[channel_name])
-        message = await channel.fetch_message(message_id)
-        await message.delete()
+        try:
+            # A partial message deletes by ID, without fetching the message first
+            await self.outbound.submit(channel.id, priority, channel.get_partial_message(message_id).delete)
+        except NotFound:
+            pass
+
+    def run_in_background(self, coroutine: Awaitable):
+        """
+        Runs follow-up work without making the caller wait for it. Failures are logged, since nothing awaits the task.
+        """
+        task = asyncio.ensure_future(coroutine)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_task_done)
+
+    def background_task_done(self, task: asyncio.Task):
+        self.background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print("Background task failed.", file=sys.stderr)
+            traceback.print_exception(type(task.exception()), task.exception(), task.exception().__traceback__,
+                                      file=sys.stderr)
 
-    async def update_commissions_information(self, randomize=True):
-        rows = self.get_standard_commissions() + self.get_special_commissions()
+    async def update_commissions_information(self, randomize=True, full_rescan=False):
+        with metrics.SYNC_SECONDS.time():
+            await self.sync_commissions(randomize, full_rescan)
+
+    async def sync_commissions(self, randomize: bool, full_rescan: bool):
+        try:
+            rows, watermarks = await self.get_commissions_info_from_spreadsheet(full_rescan)
+        except asyncio.TimeoutError:
+            print(f"Timed out after {self.sheets.timeout}s loading the Google Sheet. Skipping this update.",
+                  file=sys.stderr)
+            return
+        except HttpError as e:
+            if full_rescan:
+                print(f"Couldn't load the Google Sheet: {e}. Skipping this update.", file=sys.stderr)
+                return
+            # The new rows' ranges start at the stored watermarks, which are past the end of a sheet whose rows were
+            # deleted, so read the whole ranges instead
+            print(f"Couldn't load the new rows from the Google Sheet: {e}. Rescanning the whole sheet.",
+                  file=sys.stderr)
+            await self.sync_commissions(randomize, True)
+            return
         if randomize:
             shuffle(rows)
-        commissions_to_send = []
-        with Db() as db:
-            for row in rows:
-                commission = db.get_commission_by_email(row[0], row[2])
-                if commission is None:
-                    # Add commissions to a list, so we can possibly randomize them before sending
-                    commissions_to_send.append(self.prep_commission(db, row))
-            if commissions_to_send:
-                if randomize:
-                    shuffle(rows)
-                for commission in commissions_to_send:
-                    channel_name = await self.send_commission_embed(db, commission)
-                    await self.send_to_channel(
-                        "bot-spam",
-                        "Commission #{} has been created in channel {}".format(
-                            commission["id"],
-                            channel_name,
-                        )
-                    )
-        await self.send_commissions_status()
+
+        def ingest(db: Db) -> List[dict]:
+            # Delete TOS agreement, then add all the commissions at once, so we can possibly randomize them before
+            # sending
+            commissions = db.ingest_commissions([row[:1] + row[2:] for row in self.filter_new_rows(db, rows)])
+            # Only move the watermarks forward once the new rows are in the DB, in the same transaction
+            for sheet_name, last_row in watermarks:
+                db.set_sheet_watermark(sheet_name, last_row)
+            return commissions
+
+        commissions_to_send = await self.db.run(ingest)
+        metrics.ROWS_INGESTED.inc(len(commissions_to_send))
+        if commissions_to_send:
+            # Send each channel's new commissions in order, with the channels in parallel
+            by_channel: Dict[str, List[Callable[[], Awaitable]]] = {}
+            for commission in commissions_to_send:
+                by_channel.setdefault(self.get_queue_channel_name(commission), []).append(
+                    partial(self.send_new_commission, commission)
+                )
+            await asyncio.gather(*[self.apply_in_order(sends) for sends in by_channel.values()])
+        self.request_commissions_status()
         print("Done processing new commissions")
 
+    async def send_new_commission(self, commission: Dict):
+        channel_name = await self.send_commission_embed(commission, priority=Priority.Bulk)
+        await self.activity.add(
+            "Created",
+            "Commission #{} has been created in channel {}".format(
+                commission["id"],
+                channel_name,
+            )
+        )
+
     @staticmethod
-    def prep_commission(db: Db, row: list) -> dict:
-        del row[1]  # Delete TOS agreement
-        timestamp, email = row[0], row[1]
-        commission = db.add_commission(row)
-        # Assign the commission to someone based on artist_choice
-        if commission["artist_choice"].startswith("Any artist"):
-            assigned_to = None
+    def filter_new_rows(db: Db, rows: List[list]) -> List[list]:
+        """
+        Drops the rows that are already in the DB, or that appear earlier in the same batch
+        :param db:
+        :param rows: Raw sheet rows, with the timestamp at index 0 and the email at index 2
+        :return:
+        """
+        seen = db.get_existing_commission_keys({(row[0], row[2]) for row in rows})
+        new_rows = []
+        for row in rows:
+            key = (row[0], row[2])
+            if key not in seen:
+                seen.add(key)
+                new_rows.append(row)
+        return new_rows
+
+    async def get_commissions_info_from_spreadsheet(self, full_rescan=False) -> Tuple[List, List[Tuple[str, int]]]:
+        """
+        Fetches, in one request, the rows of every form source that come after the last row ingested from that
+        sheet. With full_rescan, the whole ranges are fetched again; rows already in the DB are skipped by the caller.
+        :param full_rescan:
+        :return: The post-processed rows, and a list of (sheet_name, last_row) watermarks to store once the rows have
+            been ingested
+        """
+        # The sources to fetch, with the first row of each one's range
+        ranges, sources = [], []
+        if full_rescan:
+            last_rows = [None] * len(self.form_sources)
         else:
-            assigned_to = commission["artist_choice"]
-        commission = db.assign_commission(assigned_to, timestamp, email)
-        # Set allow_any_artist flag
-        allow_any_artist = not commission.get("if_queue_is_full") or \
-                           "any artist" in (commission.get("if_queue_is_full") or "").lower()
-        commission = db.set_allow_any_artist(allow_any_artist, timestamp, email)
-        specialty = "specialty" in (commission.get("if_queue_is_full") or "").lower()
-        return db.set_specialty(specialty, timestamp, email)
-
-    def get_standard_commissions(self):
-        return self.get_commissions_info_from_spreadsheet("Form Responses 1!A2:M")
-
-    def get_special_commissions(self):
-        commissions_list = self.get_commissions_info_from_spreadsheet("Form Responses 2!A2:M")
-        for commission in commissions_list:
-            commission[-3] = commission[-3].split(" (")[0]
-            commission[-2] = "Specialty request"
-        return commissions_list
+            last_rows = await self.db.batch(*[("get_sheet_watermark", source.sheet_name)
+                                              for source in self.form_sources])
+        for source, last_row in zip(self.form_sources, last_rows):
+            after = source.range_after(last_row)
+            # Sources whose configured range has been read to the end are done
+            if after is not None:
+                ranges.append(after[0])
+                sources.append((source, after[1]))
+        print(f"Loading Google Sheet of commission info from {ranges}...")
+        self.syncing = True
+        try:
+            results = await self.sheets.fetch(ranges)
+        finally:
+            self.syncing = False
+        rows, watermarks = [], []
+        for (source, start_row), values in zip(sources, results):
+            rows += [source.apply(row) for row in values]
+            if values:
+                watermarks.append((source.sheet_name, start_row + len(values) - 1))
+        print(f"Got {len(rows)} results")
+        return rows, watermarks
 
-    @staticmethod
-    def get_commissions_info_from_spreadsheet(sheet_range) -> List:
-        print("Loading Google Sheet of commission info...")
-        service = build('sheets', 'v4', developerKey=GOOGLE_SHEETS_DEVELOPER_KEY)
-        # Call the Sheets API
-        sheet = service.spreadsheets()
-        thing = sheet.values().get(spreadsheetId=SHEET_ID, range=sheet_range)
-        result = thing.execute()["values"]
-        print(f"Got {len(result)} results")
-        return result
-
-    async def send_commission_embed(self, db: Db, commission: Dict, set_counter=True) -> str:
+    def get_queue_channel_name(self, commission: Dict) -> str:
         if commission["assigned_to"] is None:
-            channel_name = utils.get_channel_name("!Any artist" if commission["allow_any_artist"] else "!Void")
-        else:
-            channel_name = utils.get_channel_name(commission["assigned_to"])
+            return utils.get_channel_name("!Any artist" if commission["allow_any_artist"] else "!Void",
+                                          self.config.lookups)
+        return utils.get_channel_name(commission["assigned_to"], self.config.lookups)
+
+    async def send_commission_embed(self, commission: Dict, set_counter=True, priority=Priority.Edit) -> str:
+        channel_name = self.get_queue_channel_name(commission)
         timestamp, email = commission["timestamp"], commission["email"]
         if set_counter:
-            # Increment channel counter, to track how many messages were sent on this channel
-            counter = db.increment_channel_counter(channel_name)
-            # Update the counter value on the given commission, so it's passed to the build embed
-            commission = db.update_commission_counter(timestamp, email, counter)
+            def set_commission_counter(db: Db) -> dict:
+                # Increment channel counter, to track how many messages were sent on this channel
+                counter = db.increment_channel_counter(channel_name)
+                # Update the counter value on the given commission, so it's passed to the build embed
+                return db.update_commission_counter(timestamp, email, counter)
+
+            commission = await self.db.run(set_commission_counter)
         # Build the embed and view data
         content, embed = utils.build_embed(**commission)
         view = EmbedButtonsView(self, commission["assigned_to"] is None, **commission)
         # Send message to channel
-        message = await self.send_to_channel(channel_name, content, embed, view)
+        message = await self.send_to_channel(channel_name, content, embed, view, priority)
+        self.remember_render(message.id, content, embed, view)
         # Update the message ID for editing later
-        db.update_message_id(timestamp, email, channel_name, message_id=message.id)
+        await self.db.update_message_id(timestamp, email, channel_name, message_id=message.id)
         return channel_name
 
-    async def claim_commission(self, member: Member, message_id: int) -> Optional[dict]:
-        with Db() as db:
-            commission = db.get_commission_by_message_id(message_id)
-            # The commission must not currently be assigned to anyone to allow a claim
-            if commission["assigned_to"] is not None:
-                print(f"A user ({member}) tried to claim a commission that was already claimed. How??")
-                await member.send(
-                    f"You tried to claim a commission that was already claimed. Please tell Trick-Candle how.",
-                    delete_after=60
-                )
-                return None
-            # If the commission is exclusive and in the voided-queue, claim will give it back to the original
-            # requested artist
-            if not commission["allow_any_artist"] and commission["channel_name"] == "voided-queue":
-                name = commission["artist_choice"]
-                auto_accept = False
-            else:
-                # The claiming user must have a channel assigned to them
-                name = utils.get_name_by_member_id(member.id)
-                if name is None:
-                    print(f"An invalid user ({member}) tried to claim a commission.")
-                    await member.send("You cannot claim commissions.", delete_after=60)
-                    return None
-                # If the commission is limited to a specific artist, the claiming artist must be that artist
-                if not commission["allow_any_artist"] and commission["artist_choice"] != name:
-                    return None
-                auto_accept = True
-            old_channel_name, old_message_id = commission["channel_name"], commission["message_id"]
-            commission = db.assign_commission(name, message_id=message_id)
-            if auto_accept:
-                commission = db.accept_commission(message_id, accepted=True)
-            await self.delete_message(old_channel_name, old_message_id)
-            await self.send_commission_embed(db, commission)
-            return commission
+    async def claim_commission(self, member: Member, commission: dict) -> dict:
+        """
+        Assigns the commission to the claiming artist. Its message is left where it is; see move_commission.
+        :raises BotError: If the member isn't allowed to claim the commission
+        """
+        # If the commission is exclusive and in the voided-queue, claim will give it back to the original
+        # requested artist
+        if not commission["allow_any_artist"] and commission["channel_name"] == "voided-queue":
+            name = commission["artist_choice"]
+            auto_accept = False
+        else:
+            # The claiming user must have a channel assigned to them
+            name = utils.get_name_by_member_id(member.id, self.config.lookups)
+            if name is None:
+                print(f"An invalid user ({member}) tried to claim a commission.")
+                raise utils.BotError("You cannot claim commissions.")
+            # If the commission is limited to a specific artist, the claiming artist must be that artist
+            if not commission["allow_any_artist"] and commission["artist_choice"] != name:
+                raise utils.BotError(f"Only {commission['artist_choice']} can claim this commission.")
+            auto_accept = True
+        # The commission must not currently be assigned to anyone to allow a claim, which the transition checks
+        return await self.db.transition(commission["message_id"], "claim", commission["status_key"],
+                                        assigned_to=name, accepted=auto_accept)
 
     # @staticmethod
     # async def check_if_user_can_accept_reject(db: Db, member: Member, message_id: int, action: str):
@@ -249,43 +630,39 @@ class Functions:
     #         return None
     #     return commission
 
-    async def reject_commission(self, member: Member, message_id: int) -> bool:
-        with Db() as db:
-            commission = db.get_commission_by_message_id(message_id)
-            old_channel_name, old_message_id = commission["channel_name"], commission["message_id"]
-            db.assign_commission(None, message_id=message_id)
-            commission = db.accept_commission(message_id, accepted=False)
-            await self.send_commission_embed(db, commission)
-            await self.delete_message(old_channel_name, old_message_id)
-            return commission
+    async def reject_commission(self, member: Member, commission: dict) -> dict:
+        """
+        Unassigns the commission. Its message is left where it is; see move_commission.
+        """
+        return await self.db.transition(commission["message_id"], "reject", commission["status_key"])
 
-    @staticmethod
-    async def accept_commission(member: Member, message_id: int) -> Optional[dict]:
-        with Db() as db:
-            return db.accept_commission(message_id, accepted=True)
+    async def move_commission(self, commission: dict) -> bool:
+        """
+        Moves the commission's message to the queue channel it now belongs in, if that's changed
+        :param commission: The commission as its message was last sent, with its old channel_name and message_id
+        :return: True if the message was moved
+        """
+        old_channel_name, old_message_id = commission["channel_name"], commission["message_id"]
+        if self.get_queue_channel_name(commission) == old_channel_name:
+            return False
+        await self.send_commission_embed(commission, priority=Priority.Interaction)
+        await self.delete_message(old_channel_name, old_message_id, Priority.Interaction)
+        return True
 
-    @staticmethod
-    async def show_commission(message_id: int) -> dict:
-        with Db() as db:
-            return db.hide_commission(message_id, False)
+    async def accept_commission(self, member: Member, commission: dict) -> dict:
+        return await self.db.transition(commission["message_id"], "accept", commission["status_key"])
 
-    @staticmethod
-    async def hide_commission(message_id: int) -> dict:
-        with Db() as db:
-            return db.hide_commission(message_id, True)
+    async def show_commission(self, commission: dict) -> dict:
+        return await self.db.transition(commission["message_id"], "show", commission["status_key"])
 
-    @staticmethod
-    async def invoice_commission(message_id: int) -> dict:
-        with Db() as db:
-            return db.invoice_commission(message_id)
+    async def hide_commission(self, commission: dict) -> dict:
+        return await self.db.transition(commission["message_id"], "hide", commission["status_key"])
 
-    @staticmethod
-    async def pay_commission(message_id: int) -> dict:
-        with Db() as db:
-            return db.pay_commission(message_id)
+    async def invoice_commission(self, commission: dict) -> dict:
+        return await self.db.transition(commission["message_id"], "invoice", commission["status_key"])
 
-    @staticmethod
-    async def finish_commission(message_id: int) -> dict:
-        with Db() as db:
-            db.finish_commission(message_id)
-            return db.hide_commission(message_id, hidden=True)
+    async def pay_commission(self, commission: dict) -> dict:
+        return await self.db.transition(commission["message_id"], "pay", commission["status_key"])
+
+    async def finish_commission(self, commission: dict) -> dict:
+        return await self.db.transition(commission["message_id"], "finish", commission["status_key"])
@@ -1,11 +1,13 @@
+import asyncio
 from time import sleep
 
 import discord
-from discord.ext.commands import Bot, Context
+from discord.ext.commands import AutoShardedBot, Context
 
 from src import utils
 from src.bot import functions
 from src.bot.commands import Commands
+from src.bot.sheets import load_form_sources
 
 VERSION = (0, 1, 0)
 
@@ -16,10 +18,22 @@ TOKEN = settings["token"]
 MASTER_IDS = settings["master_id"]
 functions.GOOGLE_SHEETS_DEVELOPER_KEY = settings["developer_key"]
 functions.SHEET_ID = settings["spreadsheet_id"]
+functions.FORM_SOURCES = load_form_sources(j)
+functions.SHEETS_TIMEOUT = settings.get("sheets_timeout", functions.SHEETS_TIMEOUT)
+functions.STATUS_REFRESH_SECONDS = settings.get("status_refresh_seconds", functions.STATUS_REFRESH_SECONDS)
+functions.ACTIVITY_FLUSH_SECONDS = settings.get("activity_flush_seconds", functions.ACTIVITY_FLUSH_SECONDS)
+functions.ACTIVITY_IMMEDIATE_EVENTS = settings.get("activity_immediate_events", functions.ACTIVITY_IMMEDIATE_EVENTS)
+functions.CONFIG_WATCH_SECONDS = settings.get("config_watch_seconds", functions.CONFIG_WATCH_SECONDS)
+functions.METRICS_PORT = settings.get("metrics_port", functions.METRICS_PORT)
+functions.ARCHIVE_AFTER_DAYS = settings.get("archive_after_days", functions.ARCHIVE_AFTER_DAYS)
+# None lets Discord recommend how many shards to run
+SHARD_COUNT = settings.get("shard_count")
 
 
 def init_bot():
-    return Bot(command_prefix=PREFIX)
+    # The master IDs are also the owners for owner-only commands. Guilds are spread over the shards by Discord, and
+    # every shard's events arrive at the same cog.
+    return AutoShardedBot(command_prefix=PREFIX, owner_ids=set(MASTER_IDS), shard_count=SHARD_COUNT)
 
 
 def load_commands(bot):
@@ -41,6 +55,8 @@ def load_commands(bot):
         if context.author.id in MASTER_IDS:
             await context.channel.send("Okay, Dad. Logging out...")
             print("Logging out...")
+            # Post any buffered bot-spam notices before going offline
+            await asyncio.gather(*[f.activity.flush() for f in commands.functions.values()])
             await bot.change_presence(status=discord.Status.offline)
             sleep(1)
             await bot.close()
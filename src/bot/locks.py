@@ -0,0 +1,35 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, Hashable
+
+
+class LockRegistry:
+    """
+    Hands out one asyncio.Lock per key, so work on the same key runs one piece at a time, in the order it arrived,
+    while work on different keys runs in parallel. A key's lock is dropped as soon as nothing holds or waits for it, so
+    the registry only ever holds locks for keys that are busy.
+    """
+
+    def __init__(self):
+        self.locks: Dict[Hashable, asyncio.Lock] = {}
+        # How many callers hold or are waiting for each lock
+        self.users: Dict[Hashable, int] = {}
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable):
+        if key not in self.locks:
+            self.locks[key] = asyncio.Lock()
+        lock = self.locks[key]
+        self.users[key] = self.users.get(key, 0) + 1
+        try:
+            # asyncio.Lock wakes its waiters first in, first out
+            async with lock:
+                yield
+        finally:
+            self.users[key] -= 1
+            if self.users[key] == 0:
+                del self.users[key]
+                del self.locks[key]
+
+    def __len__(self):
+        return len(self.locks)
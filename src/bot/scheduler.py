@@ -0,0 +1,129 @@
+import asyncio
+import heapq
+import itertools
+from collections import deque
+from enum import IntEnum
+from time import perf_counter
+from typing import Awaitable, Callable, Deque, Dict, Hashable, List, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class Priority(IntEnum):
+    Interaction = 0  # Responses to a user's click
+    Edit = 1  # Keeping existing messages up to date
+    Bulk = 2  # Resends, cleanups and digests
+
+
+class OutboundScheduler:
+    """
+    Runs outbound Discord calls through one worker per key, normally the channel ID, since Discord rate-limits message
+    routes per channel. Calls on different channels run in parallel, up to max_concurrency at once, while calls on the
+    same channel run one at a time, highest priority first and in submission order within a priority. When every slot
+    is busy, the next free one goes to the most urgent waiting call on any channel.
+    """
+
+    def __init__(self, max_concurrency=8, wait_samples=1000):
+        # Each key's pending calls, as a heap of (priority, sequence, queued_at, fn, future)
+        self.queues: Dict[Hashable, List[tuple]] = {}
+        self.workers: Dict[Hashable, asyncio.Task] = {}
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        # Workers waiting for a slot, as a heap of (priority, sequence, future)
+        self.slot_waiters: List[Tuple[Priority, int, asyncio.Future]] = []
+        # Keeps calls with the same priority in submission order
+        self.sequence = itertools.count()
+        # How many calls are queued, for each priority
+        self.queued: Dict[Priority, int] = {p: 0 for p in Priority}
+        # Recent queue wait times, in seconds, for each priority
+        self.wait_times: Dict[Priority, Deque[float]] = {p: deque(maxlen=wait_samples) for p in Priority}
+        self.completed: Dict[Priority, int] = {p: 0 for p in Priority}
+
+    async def submit(self, key: Hashable, priority: Priority, fn: Callable[[], Awaitable[T]]) -> T:
+        """
+        Queues fn to be called on key's worker, and waits for its result
+        :param key: Calls with the same key run one at a time
+        :param priority:
+        :param fn: Makes the Discord call, e.g. `lambda: channel.send(content)`
+        :return: Whatever fn's awaitable returns
+        """
+        future = asyncio.get_running_loop().create_future()
+        queue = self.queues.setdefault(key, [])
+        heapq.heappush(queue, (priority, next(self.sequence), perf_counter(), fn, future))
+        self.queued[priority] += 1
+        if key not in self.workers or self.workers[key].done():
+            self.workers[key] = asyncio.create_task(self.work(key, queue))
+        return await future
+
+    async def acquire_slot(self, priority: Priority):
+        if self.active < self.max_concurrency and not self.slot_waiters:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.slot_waiters, (priority, next(self.sequence), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot may have been handed over just before the cancellation, so pass it on
+            if future.done() and not future.cancelled():
+                self.release_slot()
+            raise
+
+    def release_slot(self):
+        # Hand the slot straight to the most urgent waiter, so nothing can take it in between
+        while self.slot_waiters:
+            future = heapq.heappop(self.slot_waiters)[-1]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    async def work(self, key: Hashable, queue: List[tuple]):
+        # Runs until the queue is empty. There's no await between the final check and the cleanup, so a submit can't
+        # slip in between and be left without a worker.
+        while queue:
+            # Wait for a slot at the priority of the most urgent call, then run whichever call is most urgent by then
+            await self.acquire_slot(queue[0][0])
+            try:
+                priority, _, queued_at, fn, future = heapq.heappop(queue)
+                self.queued[priority] -= 1
+                if future.cancelled():
+                    continue
+                self.wait_times[priority].append(perf_counter() - queued_at)
+                try:
+                    result = await fn()
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+            finally:
+                self.release_slot()
+            self.completed[priority] += 1
+        del self.workers[key]
+        del self.queues[key]
+
+    def stats(self) -> dict:
+        """
+        :return: How many calls are queued and how long recent calls waited, for each priority
+        """
+        stats = {}
+        for p in Priority:
+            waits = sorted(self.wait_times[p])
+            stats[p.name] = {
+                "queued": self.queued[p],
+                "completed": self.completed[p],
+                "wait_p50_ms": waits[len(waits) // 2] * 1000 if waits else 0,
+                "wait_max_ms": waits[-1] * 1000 if waits else 0,
+            }
+        return stats
+
+    def close(self):
+        for worker in self.workers.values():
+            worker.cancel()
+        for queue in self.queues.values():
+            for item in queue:
+                item[-1].cancel()
+            queue.clear()
+        self.queued = {p: 0 for p in Priority}
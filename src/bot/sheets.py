@@ -0,0 +1,126 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import httplib2
+from googleapiclient.discovery import build
+
+from src import utils
+
+# Column order of the form responses sheets, from column A onwards
+SHEET_COLUMNS = ["timestamp", "tos", "email", "twitch", "twitter", "discord", "reference_images", "description",
+                 "expression", "notes", "artist_choice", "if_queue_is_full", "name"]
+
+# Used when the config doesn't declare any form sources
+DEFAULT_FORM_SOURCES = [
+    {
+        "range": "Form Responses 1!A2:M",
+    },
+    {
+        "range": "Form Responses 2!A2:M",
+        "split_on": {"artist_choice": " ("},
+        "set": {"if_queue_is_full": "Specialty request"},
+    },
+]
+
+
+class FormSource(NamedTuple):
+    sheet_range: str
+    split_on: Dict[str, str]
+    set_values: Dict[str, str]
+
+    @classmethod
+    def from_config(cls, source: dict) -> "FormSource":
+        for column in list(source.get("split_on", {})) + list(source.get("set", {})):
+            if column not in SHEET_COLUMNS:
+                raise ValueError("Unknown column in form source {}: {}".format(source["range"], column))
+        return cls(source["range"], source.get("split_on", {}), source.get("set", {}))
+
+    @property
+    def sheet_name(self) -> str:
+        return utils.parse_sheet_range(self.sheet_range)[0]
+
+    def range_after(self, last_row: Optional[int]) -> Optional[Tuple[str, int]]:
+        """
+        Builds the range covering every row after last_row. It starts at last_row itself rather than the row after:
+        a form's responses sheet can end right at its last response, and a range that starts below the end of the
+        sheet's grid can be rejected. The caller skips the rows that are already in the DB.
+        :param last_row: The last row already ingested, or None to get the whole range
+        :return: The range and the first row it starts at, or None if the configured range ends at or before last_row
+        """
+        sheet_name, start_col, start_row, end_col, end_row = utils.parse_sheet_range(self.sheet_range)
+        if last_row is not None:
+            if end_row is not None and last_row >= end_row:
+                return None
+            start_row = max(start_row, last_row)
+        end = end_col if end_row is None else f"{end_col}{end_row}"
+        return f"{sheet_name}!{start_col}{start_row}:{end}", start_row
+
+    def apply(self, row: list) -> list:
+        """
+        Pads the row out to a full set of columns and applies this source's post-processing rules to it
+        :param row:
+        :return:
+        """
+        row = row + [""] * (len(SHEET_COLUMNS) - len(row))
+        for column, separator in self.split_on.items():
+            i = SHEET_COLUMNS.index(column)
+            row[i] = row[i].split(separator)[0]
+        for column, value in self.set_values.items():
+            row[SHEET_COLUMNS.index(column)] = value
+        return row
+
+
+def load_form_sources(config: dict) -> List[FormSource]:
+    return [FormSource.from_config(source) for source in config.get("form_sources", DEFAULT_FORM_SOURCES)]
+
+
+class SheetsClient:
+    """
+    Holds one Sheets API client for the life of the bot, instead of rebuilding it on every fetch. The blocking HTTP
+    calls run on a dedicated worker thread so the event loop keeps serving interactions during a sync.
+    """
+
+    def __init__(self, developer_key: str, spreadsheet_id: str, timeout: float=30):
+        self.developer_key = developer_key
+        self.spreadsheet_id = spreadsheet_id
+        self.timeout = timeout
+        self.service = None
+        # httplib2 connections aren't thread-safe, so every request goes through the same single thread
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sheets")
+
+    def get_service(self):
+        if self.service is None:
+            # The socket timeout bounds how long a stuck request can hold the worker thread after being cancelled
+            self.service = build('sheets', 'v4', developerKey=self.developer_key,
+                                 http=httplib2.Http(timeout=self.timeout))
+        return self.service
+
+    def batch_get(self, ranges: List[str]) -> List[List[list]]:
+        """
+        Fetches all the given ranges in a single request. This blocks, so call fetch() from async code.
+        :param ranges:
+        :return: The rows of each range, in the same order as the ranges
+        """
+        if not ranges:
+            return []
+        result = self.get_service().spreadsheets().values().batchGet(
+            spreadsheetId=self.spreadsheet_id,
+            ranges=ranges
+        ).execute()
+        # The "values" key is left out entirely when a range has no rows
+        return [value_range.get("values", []) for value_range in result.get("valueRanges", [])]
+
+    async def fetch(self, ranges: List[str]) -> List[List[list]]:
+        """
+        Runs batch_get on the worker thread
+        :param ranges:
+        :return:
+        :raises asyncio.TimeoutError: If the request takes longer than the timeout
+        :raises googleapiclient.errors.HttpError: If the API refuses the request, e.g. for a range outside the sheet
+        """
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(loop.run_in_executor(self.executor, self.batch_get, ranges), self.timeout)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
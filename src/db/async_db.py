@@ -0,0 +1,107 @@
+import asyncio
+import queue
+import threading
+from types import GeneratorType
+from time import perf_counter
+from typing import Any, Callable, List, Optional, Tuple, TypeVar
+
+from src import metrics
+from src.db.db import Db, open_database
+
+T = TypeVar("T")
+
+
+def _materialize(result):
+    # Generators have to be drained on the DB thread, while their cursor is still valid
+    return list(result) if isinstance(result, GeneratorType) else result
+
+
+def _set_result(future: asyncio.Future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future: asyncio.Future, exception: BaseException):
+    if not future.done():
+        future.set_exception(exception)
+
+
+class AsyncDb:
+    """
+    Awaitable facade over Db. All DB work runs on one dedicated thread, fed by a request queue, so a slow disk write or
+    lock wait never blocks the event loop. Every Db method is available as a coroutine with the same arguments, e.g.
+    `await adb.get_commission_by_message_id(message_id)`, and runs in its own transaction.
+    """
+
+    def __init__(self, filename: str=None):
+        self.filename = filename
+        self.requests: "queue.Queue[Optional[Tuple[asyncio.AbstractEventLoop, asyncio.Future, Callable, bool, str]]]" \
+            = queue.Queue()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self.thread is None:
+            open_database(self.filename)
+            self.thread = threading.Thread(target=self._run, name="db", daemon=True)
+            self.thread.start()
+
+    def close(self):
+        if self.thread is not None:
+            self.requests.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            loop, future, fn, readonly, name = request
+            if future.cancelled():
+                continue
+            start = perf_counter()
+            try:
+                with Db(self.filename, readonly=readonly) as db:
+                    result = _materialize(fn(db))
+            except BaseException as e:
+                loop.call_soon_threadsafe(_set_exception, future, e)
+            else:
+                loop.call_soon_threadsafe(_set_result, future, result)
+            finally:
+                metrics.DB_CALL_SECONDS.observe(perf_counter() - start, method=name)
+
+    async def run(self, fn: Callable[[Db], T], readonly=False, name: str=None) -> T:
+        """
+        Runs fn with a Db on the DB thread, in a single transaction. Use this for anything that needs several
+        statements to be applied together.
+        :param fn:
+        :param readonly: Run on a read-only connection
+        :param name: What to report the call's timing as. Defaults to fn's name.
+        :return: Whatever fn returns
+        """
+        if self.thread is None:
+            raise RuntimeError("AsyncDb has not been started")
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.requests.put((loop, future, fn, readonly, name or getattr(fn, "__name__", "run")))
+        return await future
+
+    async def batch(self, *calls: Tuple[Any, ...], readonly=True) -> List[Any]:
+        """
+        Runs several Db calls in one trip to the DB thread
+        :param calls: Tuples of the Db method name followed by its arguments, e.g. ("get_commission_by_id", 3)
+        :param readonly: Run on a read-only connection
+        :return: The result of each call, in order
+        """
+        return await self.run(lambda db: [_materialize(getattr(db, name)(*args)) for name, *args in calls], readonly,
+                              "+".join(name for name, *_ in calls))
+
+    def __getattr__(self, name: str):
+        if name.startswith("_") or not callable(getattr(Db, name, None)):
+            raise AttributeError(name)
+
+        async def call(*args, **kwargs):
+            return await self.run(lambda db: getattr(db, name)(*args, **kwargs), name=name)
+
+        call.__name__ = name
+        return call
@@ -1,39 +1,34 @@
 import os
 import sqlite3
+import sys
 
-from src.utils import CHANNELS, load_config
+if __name__ == "__main__":
+    # Allow running this file directly, from any folder
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from src.db import db as db_module
+from src.db.migrations import migrate
 
 
 def open_db():
-    os.makedirs("../../database_files/", exist_ok=True)
-    db = sqlite3.connect("../../database_files/main.db")
+    os.makedirs(os.path.dirname(db_module.DB_FILE), exist_ok=True)
+    db = sqlite3.connect(db_module.DB_FILE)
     cur = db.cursor()
     return db, cur
 
 
-def get_version(cur):
-    sql = "SELECT version FROM version"
-    try:
-        version = cur.execute(sql).fetchone()[0]
-    except sqlite3.OperationalError:
-        return 0
-    else:
-        return version
-
-
-def set_version(cur, v):
-    sql = "UPDATE version SET version = ?"
-    cur.execute(sql, [v])
-    print(f"Set version to {v}")
-
-
 def drop_tables(cur):
     print("Dropping all tables in database...")
 
     sql = """
+        DROP VIEW IF EXISTS all_commissions;
         DROP TABLE IF EXISTS version;
         DROP TABLE IF EXISTS commissions;
         DROP TABLE IF EXISTS channels;
+        DROP TABLE IF EXISTS sheet_watermarks;
+        DROP TABLE IF EXISTS status_messages;
+        DROP TABLE IF EXISTS commission_counts;
+        DROP TABLE IF EXISTS archived_commissions;
     """
     cur.executescript(sql)
 
@@ -43,83 +38,8 @@ def drop_tables(cur):
         raise Exception(f"Some tables were not deleted: {tables}")
 
 
-def create_tables(cur):
-    if get_version(cur) >= 1:
-        print("Skipping creating tables...")
-        return
-
-    print("Creating tables...")
-
-    # Create version table and initialize with 0
-    sql = """
-    CREATE TABLE IF NOT EXISTS version (
-        version INTEGER PRIMARY KEY
-    );
-    INSERT INTO version (version) VALUES (0);
-    """
-    cur.executescript(sql)
-
-    sql = """
-    CREATE TABLE IF NOT EXISTS commissions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        timestamp TIMESTAMP,
-        name TEXT DEFAULT '',
-        email TEXT DEFAULT '',
-        twitch TEXT DEFAULT '',
-        twitter TEXT DEFAULT '',
-        discord TEXT DEFAULT '',
-        reference_images TEXT DEFAULT '',
-        description TEXT DEFAULT '',
-        expression TEXT DEFAULT '',
-        notes TEXT DEFAULT '',
-        artist_choice TEXT DEFAULT '',
-        if_queue_is_full TEXT DEFAULT '',
-        assigned_to TEXT DEFAULT NULL,
-        allow_any_artist BOOLEAN DEFAULT FALSE,
-        hidden BOOLEAN DEFAULT FALSE,
-        accepted BOOLEAN DEFAULT FALSE,
-        invoiced BOOLEAN DEFAULT FALSE,
-        paid BOOLEAN DEFAULT FALSE,
-        finished BOOLEAN DEFAULT FALSE,
-        channel_name TEXT DEFAULT NULL,
-        message_id INTEGER DEFAULT NULL,
-        counter INTEGER DEFAULT NULL,
-        UNIQUE (timestamp, email) ON CONFLICT IGNORE
-    );
-    CREATE TABLE IF NOT EXISTS channels (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        channel_name TEXT UNIQUE,
-        counter INTEGER DEFAULT -1
-    );
-    PRAGMA case_sensitive_like=ON;
-    """
-    cur.executescript(sql)
-
-    j = load_config("../../conf/config.json")
-    sql = "INSERT INTO channels(channel_name) VALUES (?);"
-    cur.executemany(sql, [[c] for c in j["channels"].keys()])
-
-    set_version(cur, 1)
-
-
-def add_specialty_column(cur):
-    if get_version(cur) >= 2:
-        print("Skipping adding 'specialty' column...")
-        return
-
-    print("Adding 'specialty' column...")
-
-    sql = """
-    ALTER TABLE commissions
-    ADD COLUMN specialty BOOLEAN DEFAULT FALSE;
-    """
-    cur.executescript(sql)
-
-    set_version(cur, 2)
-
-
 def show_tables(cur):
-    sql = "SELECT sql FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%';"
+    sql = "SELECT sql FROM sqlite_master WHERE type IN ('table', 'index') AND sql IS NOT NULL;"
     for row in cur.execute(sql).fetchall():
         print(row[0])
 
@@ -128,9 +48,8 @@ def main():
     db, cur = open_db()
 
     # drop_tables(cur)
-    create_tables(cur)
-    add_specialty_column(cur)
-    db.commit()
+    version = migrate(db, verbose=True)
+    print(f"Database is at version {version}")
 
     show_tables(cur)
 
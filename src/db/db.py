@@ -1,16 +1,168 @@
+import os
 import sqlite3
+import threading
 from collections import OrderedDict
-from typing import List, Optional
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple, Iterable
 
-VERSION_NEEDED = 2
+from src import metrics
+from src.db.migrations import ARCHIVE_COLUMNS_V8, LATEST_VERSION, REPO_ROOT, migrate
+
+VERSION_NEEDED = LATEST_VERSION
+DB_FILE = os.path.join(REPO_ROOT, "database_files", "main.db")
+# The columns archive_finished_commissions copies into archived_commissions. Extend it when a migration adds a column
+# to the archive.
+ARCHIVED_COLUMNS = ARCHIVE_COLUMNS_V8
+
+
+class Transition(NamedTuple):
+    # The SET clause to apply, with :named parameters for any values the caller passes in
+    changes: str
+    # The WHERE condition the row must meet for the transition to be allowed, in terms of status_key (see
+    # migrations.add_status_key_column), the status flags and assigned_to
+    allowed_from: str
+
+
+# Every change a button can make to a commission
+TRANSITIONS: Dict[str, Transition] = {
+    "claim": Transition("assigned_to=:assigned_to, accepted=:accepted", "assigned_to IS NULL AND status_key IN (0, 1)"),
+    # A commission that names an artist but lets anyone take it over is assigned with a status_key of 0, so these two
+    # go by the flags rather than by status_key alone
+    "reject": Transition("assigned_to=NULL, accepted=FALSE", "assigned_to IS NOT NULL AND status_key < 3"),
+    "accept": Transition("accepted=TRUE", "assigned_to IS NOT NULL AND NOT accepted AND status_key < 3"),
+    "show": Transition("hidden=FALSE", "TRUE"),
+    "hide": Transition("hidden=TRUE", "TRUE"),
+    "invoice": Transition("invoiced=TRUE", "status_key = 2"),
+    "pay": Transition("paid=TRUE", "status_key = 3"),
+    "finish": Transition("finished=TRUE, hidden=TRUE, finished_at=CURRENT_TIMESTAMP", "status_key IN (2, 3, 4)"),
+}
+
+
+class TransitionConflict(Exception):
+    """
+    Raised when a commission isn't in a state the requested transition can be applied to, usually because someone else
+    changed it first
+    """
+
+    def __init__(self, action: str, message_id: int, current: Optional[dict]):
+        self.action = action
+        self.message_id = message_id
+        # The commission as it is now, or None if no commission has that message ID any more
+        self.current = current
+        state = "no longer exists" if current is None else f"has status_key {current['status_key']}"
+        super().__init__(f"Can't {action} the commission on message {message_id}: it {state}")
+
+
+class ConnectionPool:
+    """
+    Keeps the connections to one database file open for the life of the bot: a writer connection that read-write Dbs
+    take turns to use, and a pool of read-only connections that are handed out and returned. A read-write Db that's
+    opened while another one has the writer gets a connection of its own, so two callers never share a transaction.
+    Pending migrations are applied and the schema version is checked once, when the pool is opened.
+    """
+
+    def __init__(self, filename: str, apply_migrations=True):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.idle_readers: List[sqlite3.Connection] = []
+        self.writer_in_use = False
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.writer = self.connect()
+        if apply_migrations:
+            migrate(self.writer)
+        check_version(self.writer.cursor())
+
+    def connect(self, readonly=False) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.filename, check_same_thread=False, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute("PRAGMA cache_size=-16000;")  # 16 MB
+        conn.set_trace_callback(metrics.count_statement)
+        if readonly:
+            conn.execute("PRAGMA query_only=ON;")
+        return conn
+
+    def get_writer(self) -> sqlite3.Connection:
+        with self.lock:
+            if not self.writer_in_use:
+                self.writer_in_use = True
+                return self.writer
+        return self.connect()
+
+    def release_writer(self, conn: sqlite3.Connection):
+        # Drop anything the caller didn't commit, so it can't end up in the next caller's transaction
+        conn.rollback()
+        if conn is self.writer:
+            with self.lock:
+                self.writer_in_use = False
+        else:
+            conn.close()
+
+    def get_reader(self) -> sqlite3.Connection:
+        with self.lock:
+            if self.idle_readers:
+                return self.idle_readers.pop()
+        return self.connect(readonly=True)
+
+    def release_reader(self, conn: sqlite3.Connection):
+        # End the read transaction, so the reader doesn't hold back WAL checkpoints while idle
+        conn.rollback()
+        with self.lock:
+            self.idle_readers.append(conn)
+
+    def close(self):
+        with self.lock:
+            for conn in self.idle_readers + [self.writer]:
+                conn.close()
+            self.idle_readers = []
+
+
+POOLS: Dict[str, ConnectionPool] = {}
+POOLS_LOCK = threading.Lock()
+
+
+def open_database(filename: str=None, apply_migrations=True) -> ConnectionPool:
+    """
+    Opens the connection pool for the given file, if it isn't open already
+    :param filename: Defaults to DB_FILE
+    :param apply_migrations: Bring the schema up to date before checking its version
+    :return:
+    """
+    filename = filename or DB_FILE
+    with POOLS_LOCK:
+        if filename not in POOLS:
+            POOLS[filename] = ConnectionPool(filename, apply_migrations)
+        return POOLS[filename]
+
+
+def guild_db_file(guild_id: int) -> str:
+    """
+    Each guild's commissions, channels and status messages are kept in their own file, next to DB_FILE
+    """
+    return os.path.join(os.path.dirname(DB_FILE), f"guild-{guild_id}.db")
+
+
+def close_database(filename: str=None):
+    filename = filename or DB_FILE
+    with POOLS_LOCK:
+        pool = POOLS.pop(filename, None)
+    if pool:
+        pool.close()
+
+
+def check_version(cur: sqlite3.Cursor):
+    sql = "SELECT version FROM version;"
+    version = cur.execute(sql).fetchone()[0]
+    if not version == VERSION_NEEDED:
+        raise ValueError(f"Incorrect DB version: {version} != {VERSION_NEEDED}")
 
 
 class Db:
 
-    def __init__(self, filename="database_files/main.db", auto_commit=True):
-        self.conn = sqlite3.connect(filename)
+    def __init__(self, filename: str=None, auto_commit=True, readonly=False):
+        self.pool = open_database(filename)
+        self.readonly = readonly
+        self.conn = self.pool.get_reader() if readonly else self.pool.get_writer()
         self.cur = self.conn.cursor()
-        self.check_version()
         self.auto_commit = auto_commit
 
     def __enter__(self):
@@ -27,8 +179,15 @@ class Db:
                 self.close()
 
     def close(self):
+        """
+        Hands the connection back to the pool instead of closing it. Uncommitted changes are rolled back.
+        """
         if self.conn:
-            self.conn.close()
+            if self.readonly:
+                self.pool.release_reader(self.conn)
+            else:
+                self.pool.release_writer(self.conn)
+            self.conn = None
 
     def row_to_dict(self, row):
         d = OrderedDict()
@@ -43,41 +202,108 @@ class Db:
         return self.row_to_dict(result)
 
     def check_version(self):
-        sql = "SELECT version FROM version;"
-        version = self.cur.execute(sql).fetchone()[0]
-        if not version == VERSION_NEEDED:
-            raise ValueError(f"Incorrect DB version: {version} != {VERSION_NEEDED}")
+        check_version(self.cur)
 
     def get_all_commissions(self) -> List[dict]:
+        """
+        Every commission, including archived ones, in ID order. For history; the queues only need
+        get_active_commissions.
+        """
         sql = """
-            SELECT * FROM commissions;
+            SELECT * FROM all_commissions ORDER BY id;
         """
         for row in self.cur.execute(sql).fetchall():
             yield self.row_to_dict(row)
 
-    def get_all_commissions_for_queue(self, channel_name: str) -> List[dict]:
+    def get_active_commissions_for_queue(self, channel_name: str) -> List[dict]:
         sql = """
-            SELECT * FROM commissions WHERE channel_name=?;
+            SELECT * FROM commissions WHERE channel_name=? AND status_key < 5;
         """
         for row in self.cur.execute(sql, [channel_name]).fetchall():
             yield self.row_to_dict(row)
 
-    def add_commission(self, row) -> dict:
+    def get_active_commissions(self) -> List[dict]:
+        """
+        Every commission that isn't finished, in ID order. The condition has to match the commissions_active index
+        exactly for SQLite to use it.
+        """
+        sql = """
+            SELECT * FROM commissions WHERE status_key < 5 ORDER BY id;
+        """
+        for row in self.cur.execute(sql).fetchall():
+            yield self.row_to_dict(row)
+
+    def get_status_counts(self, assigned_to: str=None) -> Dict[int, int]:
+        """
+        :param assigned_to: Only count this artist's commissions, or "" for unassigned ones
+        :return: How many commissions there are in each status, keyed by status_key
+        """
+        if assigned_to is None:
+            sql = """
+                SELECT status_key, SUM(count) FROM commission_counts GROUP BY status_key;
+            """
+            params = []
+        else:
+            sql = """
+                SELECT status_key, count FROM commission_counts WHERE assigned_to=?;
+            """
+            params = [assigned_to]
+        return {status_key: count for status_key, count in self.cur.execute(sql, params).fetchall() if count}
+
+    def ingest_commissions(self, rows: List[list]) -> List[dict]:
+        """
+        Inserts a batch of commissions with one executemany, working out assigned_to, allow_any_artist and specialty
+        up front. Runs inside this Db's transaction, so the whole batch is committed together.
+        :param rows: One list per commission of timestamp, email, twitch, twitter, discord, reference_images,
+            description, expression, notes, artist_choice, if_queue_is_full and name, in that order. That's
+            sheets.SHEET_COLUMNS without tos.
+        :return: The inserted commissions, in insertion order. Rows that already exist are skipped.
+        """
         sql = """
-        INSERT INTO commissions(timestamp, email, twitch, twitter, discord, 
-            reference_images, description, expression, notes, artist_choice, if_queue_is_full, name) 
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        RETURNING *;
+        INSERT INTO commissions(timestamp, email, twitch, twitter, discord, reference_images, description, expression, 
+            notes, artist_choice, if_queue_is_full, name, assigned_to, allow_any_artist, specialty) 
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
         """
-        values = row.copy()
-        # print(f"Adding to DB: {values}")
-        return self.fetch_dict(sql, values)
+        last_id = self.cur.execute("SELECT COALESCE(MAX(id), 0) FROM commissions;").fetchone()[0]
+        self.cur.executemany(sql, [row + list(self.derive_commission_fields(row[9], row[10])) for row in rows])
+        sql = """
+            SELECT * FROM commissions WHERE id>? ORDER BY id;
+        """
+        return [self.row_to_dict(row) for row in self.cur.execute(sql, [last_id]).fetchall()]
 
-    def get_commission_by_email(self, timestamp: str, email: str) -> Optional[dict]:
+    @staticmethod
+    def derive_commission_fields(artist_choice: str,
+                                 if_queue_is_full: Optional[str]) -> Tuple[Optional[str], bool, bool]:
+        """
+        :param artist_choice:
+        :param if_queue_is_full:
+        :return: assigned_to, allow_any_artist and specialty for a new commission
+        """
+        # Assign the commission to someone based on artist_choice
+        assigned_to = None if artist_choice.startswith("Any artist") else artist_choice
+        if_queue_is_full = (if_queue_is_full or "").lower()
+        allow_any_artist = not if_queue_is_full or "any artist" in if_queue_is_full
+        specialty = "specialty" in if_queue_is_full
+        return assigned_to, allow_any_artist, specialty
+
+    def get_existing_commission_keys(self, keys: Iterable[Tuple[str, str]]) -> Set[Tuple[str, str]]:
+        """
+        Checks a whole batch of (timestamp, email) keys against the commissions table in one query, by joining a temp
+        table of the keys against the UNIQUE (timestamp, email) index
+        :param keys:
+        :return: The subset of keys that already have a commission, live or archived
+        """
+        self.cur.execute("CREATE TEMP TABLE IF NOT EXISTS incoming_keys (timestamp TIMESTAMP, email TEXT);")
+        self.cur.execute("DELETE FROM incoming_keys;")
+        self.cur.executemany("INSERT INTO incoming_keys(timestamp, email) VALUES (?, ?);", keys)
         sql = """
-            SELECT * FROM commissions WHERE timestamp=? AND email=?;
+            SELECT c.timestamp, c.email FROM incoming_keys k 
+            JOIN commissions c ON c.timestamp=k.timestamp AND c.email=k.email
+            UNION
+            SELECT a.timestamp, a.email FROM incoming_keys k 
+            JOIN archived_commissions a ON a.timestamp=k.timestamp AND a.email=k.email;
         """
-        return self.fetch_dict(sql, [timestamp, email])
+        return {tuple(row) for row in self.cur.execute(sql).fetchall()}
 
     def get_commission_by_message_id(self, message_id: int) -> Optional[dict]:
         sql = """
@@ -86,10 +312,45 @@ class Db:
         return self.fetch_dict(sql, [message_id])
 
     def get_commission_by_id(self, db_id: int) -> Optional[dict]:
+        """
+        Looks in the live commissions first, and only in the archive if it isn't there
+        """
         sql = """
             SELECT * FROM commissions WHERE id=?;
         """
-        return self.fetch_dict(sql, [db_id])
+        commission = self.fetch_dict(sql, [db_id])
+        if commission is None:
+            sql = """
+                SELECT * FROM archived_commissions WHERE id=?;
+            """
+            commission = self.fetch_dict(sql, [db_id])
+        return commission
+
+    def archive_finished_commissions(self, grace_seconds: float) -> List[dict]:
+        """
+        Moves the commissions finished more than grace_seconds ago from commissions to archived_commissions. Their
+        entries in commission_counts are kept.
+        :param grace_seconds:
+        :return: The archived commissions, with the channel_name and message_id they were last on
+        """
+        # Worked out once, so both statements agree on which commissions to move
+        cutoff = self.cur.execute("SELECT datetime('now', ?);", [f"-{grace_seconds} seconds"]).fetchone()[0]
+        columns = ", ".join(ARCHIVED_COLUMNS)
+        sql = f"""
+            INSERT INTO archived_commissions({columns})
+            SELECT {columns} FROM commissions WHERE status_key = 5 AND finished_at <= ?;
+        """
+        self.cur.execute(sql, [cutoff])
+        sql = """
+            DELETE FROM commissions WHERE status_key = 5 AND finished_at <= ? RETURNING *;
+        """
+        return [self.row_to_dict(row) for row in self.cur.execute(sql, [cutoff]).fetchall()]
+
+    def add_channels(self, channel_names: List[str]):
+        sql = """
+            INSERT OR IGNORE INTO channels(channel_name) VALUES (?);
+        """
+        self.cur.executemany(sql, [[c] for c in channel_names])
 
     def increment_channel_counter(self, channel_name: str) -> int:
         sql = """
@@ -109,57 +370,93 @@ class Db:
         """
         return self.fetch_dict(sql, [channel_name, message_id, timestamp, email])
 
-    def assign_commission(self, assigned_to: Optional[str], timestamp: str=None, email: str=None,
-                          message_id: int=None) -> dict:
-        if timestamp and email:
-            sql = "UPDATE commissions SET assigned_to=? WHERE timestamp=? AND email=? RETURNING *;"
-            params = [assigned_to, timestamp, email]
-        elif message_id:
-            sql = "UPDATE commissions SET assigned_to=? WHERE message_id=? RETURNING *;"
-            params = [assigned_to, message_id]
-        else:
-            raise ValueError("Either message_id or (timestamp and email) must be set.")
-        return self.fetch_dict(sql, params)
-
-    def set_allow_any_artist(self, allow_any_artist: bool, timestamp: str=None, email: str=None) -> dict:
-        sql = "UPDATE commissions SET allow_any_artist=? WHERE timestamp=? AND email=? RETURNING *;"
-        params = [allow_any_artist, timestamp, email]
-        return self.fetch_dict(sql, params)
+    def get_sheet_watermark(self, sheet_name: str) -> Optional[int]:
+        sql = """
+            SELECT last_row FROM sheet_watermarks WHERE sheet_name=?;
+        """
+        result = self.cur.execute(sql, [sheet_name]).fetchone()
+        return result[0] if result else None
 
-    def set_specialty(self, specialty: bool, timestamp: str=None, email: str=None) -> dict:
-        sql = "UPDATE commissions SET specialty=? WHERE timestamp=? AND email=? RETURNING *;"
-        params = [specialty, timestamp, email]
-        return self.fetch_dict(sql, params)
+    def set_sheet_watermark(self, sheet_name: str, last_row: int):
+        sql = """
+            INSERT INTO sheet_watermarks(sheet_name, last_row) VALUES (?, ?)
+            ON CONFLICT(sheet_name) DO UPDATE SET last_row=excluded.last_row;
+        """
+        self.cur.execute(sql, [sheet_name, last_row])
 
-    def accept_commission(self, message_id: int, accepted=True):
+    def get_tracked_message_ids(self, channel_name: str) -> List[int]:
+        """
+        :param channel_name:
+        :return: The IDs of every commission and status message the bot has sent to the channel and not deleted
+        """
         sql = """
-            UPDATE commissions SET accepted=? WHERE message_id=? RETURNING *; 
+            SELECT message_id FROM commissions WHERE channel_name=? AND message_id IS NOT NULL
+            UNION
+            SELECT message_id FROM status_messages WHERE channel_name=? AND message_id IS NOT NULL;
         """
-        return self.fetch_dict(sql, [accepted, message_id])
+        return [row[0] for row in self.cur.execute(sql, [channel_name, channel_name]).fetchall()]
 
-    def hide_commission(self, message_id: int, hidden):
+    def clear_message_ids(self, channel_name: str):
+        """
+        Forgets every message the bot has sent to the channel, after they've been deleted
+        :param channel_name:
+        """
+        self.cur.execute("UPDATE commissions SET message_id=NULL WHERE channel_name=?;", [channel_name])
+        self.clear_status_messages(channel_name)
+
+    def forget_message_ids(self, message_ids: List[int]):
+        self.cur.executemany("UPDATE commissions SET message_id=NULL WHERE message_id=?;", [[i] for i in message_ids])
+        self.cur.executemany("DELETE FROM status_messages WHERE message_id=?;", [[i] for i in message_ids])
+
+    def get_status_messages(self) -> List[dict]:
         sql = """
-            UPDATE commissions SET hidden=? WHERE message_id=? RETURNING *; 
+            SELECT * FROM status_messages ORDER BY page;
         """
-        return self.fetch_dict(sql, [hidden, message_id])
+        for row in self.cur.execute(sql).fetchall():
+            yield self.row_to_dict(row)
 
-    def invoice_commission(self, message_id: int, invoiced=True):
+    def set_status_message(self, page: int, channel_name: str, message_id: int, content: str, first_id=0):
         sql = """
-            UPDATE commissions SET invoiced=? WHERE message_id=? RETURNING *; 
+            INSERT INTO status_messages(page, channel_name, message_id, content, first_id) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(page) DO UPDATE SET channel_name=excluded.channel_name, message_id=excluded.message_id, 
+                content=excluded.content, first_id=excluded.first_id;
         """
-        return self.fetch_dict(sql, [invoiced, message_id])
+        self.cur.execute(sql, [page, channel_name, message_id, content, first_id])
 
-    def pay_commission(self, message_id: int, paid=True):
+    def delete_status_message(self, page: int):
         sql = """
-            UPDATE commissions SET paid=? WHERE message_id=? RETURNING *; 
+            DELETE FROM status_messages WHERE page=?;
         """
-        return self.fetch_dict(sql, [paid, message_id])
+        self.cur.execute(sql, [page])
 
-    def finish_commission(self, message_id: int, finished=True):
+    def clear_status_messages(self, channel_name: str):
         sql = """
-            UPDATE commissions SET finished=? WHERE message_id=? RETURNING *; 
+            DELETE FROM status_messages WHERE channel_name=?;
+        """
+        self.cur.execute(sql, [channel_name])
+
+    def transition(self, message_id: int, action: str, expected_state: int=None, **values) -> dict:
+        """
+        Applies one of the TRANSITIONS to a commission as a single conditional UPDATE, so there's no gap between
+        checking the commission's state and changing it
+        :param message_id: The message the commission's buttons are on
+        :param action: A key of TRANSITIONS
+        :param expected_state: The status_key the caller last saw, if the change should only apply if it's unchanged
+        :param values: Values for the transition's named parameters, e.g. assigned_to for "claim"
+        :return: The commission after the change
+        :raises TransitionConflict: If the commission isn't in a state the transition allows
+        """
+        transition = TRANSITIONS[action]
+        sql = f"""
+            UPDATE commissions SET {transition.changes}
+            WHERE message_id=:message_id AND ({transition.allowed_from})
+                AND (:expected_state IS NULL OR status_key=:expected_state)
+            RETURNING *;
         """
-        return self.fetch_dict(sql, [finished, message_id])
+        commission = self.fetch_dict(sql, dict(values, message_id=message_id, expected_state=expected_state))
+        if commission is None:
+            raise TransitionConflict(action, message_id, self.get_commission_by_message_id(message_id))
+        return commission
 
 #
 # if __name__ == "__main__":
@@ -0,0 +1,300 @@
+import os
+import sqlite3
+from typing import Callable, List, NamedTuple
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable[[sqlite3.Cursor], None]
+
+
+def get_version(cur: sqlite3.Cursor) -> int:
+    sql = "SELECT version FROM version"
+    try:
+        version = cur.execute(sql).fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0
+    else:
+        return version
+
+
+def set_version(cur: sqlite3.Cursor, v: int):
+    sql = "UPDATE version SET version = ?"
+    cur.execute(sql, [v])
+
+
+def has_column(cur: sqlite3.Cursor, table: str, column: str) -> bool:
+    return any(row[1] == column for row in cur.execute(f"PRAGMA table_info({table});").fetchall())
+
+
+def create_tables(cur: sqlite3.Cursor):
+    # Create version table and initialize with 0
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS version (
+        version INTEGER PRIMARY KEY
+    );
+    """)
+    if cur.execute("SELECT COUNT(*) FROM version;").fetchone()[0] == 0:
+        cur.execute("INSERT INTO version (version) VALUES (0);")
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS commissions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp TIMESTAMP,
+        name TEXT DEFAULT '',
+        email TEXT DEFAULT '',
+        twitch TEXT DEFAULT '',
+        twitter TEXT DEFAULT '',
+        discord TEXT DEFAULT '',
+        reference_images TEXT DEFAULT '',
+        description TEXT DEFAULT '',
+        expression TEXT DEFAULT '',
+        notes TEXT DEFAULT '',
+        artist_choice TEXT DEFAULT '',
+        if_queue_is_full TEXT DEFAULT '',
+        assigned_to TEXT DEFAULT NULL,
+        allow_any_artist BOOLEAN DEFAULT FALSE,
+        hidden BOOLEAN DEFAULT FALSE,
+        accepted BOOLEAN DEFAULT FALSE,
+        invoiced BOOLEAN DEFAULT FALSE,
+        paid BOOLEAN DEFAULT FALSE,
+        finished BOOLEAN DEFAULT FALSE,
+        channel_name TEXT DEFAULT NULL,
+        message_id INTEGER DEFAULT NULL,
+        counter INTEGER DEFAULT NULL,
+        UNIQUE (timestamp, email) ON CONFLICT IGNORE
+    );
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS channels (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        channel_name TEXT UNIQUE,
+        counter INTEGER DEFAULT -1
+    );
+    """)
+    # The rows for the configured channels are added by Db.add_channels when the bot starts, so opening a database
+    # never depends on, or changes, the loaded config
+
+
+def add_specialty_column(cur: sqlite3.Cursor):
+    if not has_column(cur, "commissions", "specialty"):
+        cur.execute("ALTER TABLE commissions ADD COLUMN specialty BOOLEAN DEFAULT FALSE;")
+
+
+def add_sheet_watermarks_table(cur: sqlite3.Cursor):
+    # Tracks the last spreadsheet row ingested from each form responses sheet
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS sheet_watermarks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sheet_name TEXT UNIQUE,
+        last_row INTEGER DEFAULT NULL
+    );
+    """)
+
+
+def add_lookup_indexes(cur: sqlite3.Cursor):
+    cur.execute("CREATE INDEX IF NOT EXISTS commissions_message_id ON commissions(message_id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS commissions_channel_name ON commissions(channel_name);")
+    cur.execute("CREATE INDEX IF NOT EXISTS commissions_assigned_to ON commissions(assigned_to);")
+    cur.execute("""
+    CREATE INDEX IF NOT EXISTS commissions_status_flags
+    ON commissions(finished, paid, invoiced, accepted, allow_any_artist);
+    """)
+
+
+def add_status_messages_table(cur: sqlite3.Cursor):
+    # Remembers the status message(s) and the content last sent to them, so refreshes don't have to search the channel
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS status_messages (
+        page INTEGER PRIMARY KEY,
+        channel_name TEXT,
+        message_id INTEGER,
+        content TEXT DEFAULT ''
+    );
+    """)
+
+
+def add_status_page_boundaries(cur: sqlite3.Cursor):
+    # The first commission ID on each status page, so page boundaries stay put between refreshes
+    if not has_column(cur, "status_messages", "first_id"):
+        cur.execute("ALTER TABLE status_messages ADD COLUMN first_id INTEGER DEFAULT 0;")
+
+
+def add_status_key_column(cur: sqlite3.Cursor):
+    # The commission's status as an integer, matching the sort_key of utils.Status, so the status board can read only
+    # the active commissions. 5 is Status.Finished.
+    if not has_column(cur, "commissions", "status_key"):
+        cur.execute("""
+        ALTER TABLE commissions ADD COLUMN status_key INTEGER GENERATED ALWAYS AS (
+            CASE
+                WHEN finished THEN 5
+                WHEN paid THEN 4
+                WHEN invoiced THEN 3
+                WHEN accepted THEN 2
+                WHEN allow_any_artist THEN 0
+                ELSE 1
+            END
+        ) VIRTUAL;
+        """)
+    cur.execute("CREATE INDEX IF NOT EXISTS commissions_status_key ON commissions(status_key);")
+    cur.execute("CREATE INDEX IF NOT EXISTS commissions_active ON commissions(id) WHERE status_key < 5;")
+
+    # How many commissions each artist has in each status, kept up to date by the triggers below. Unassigned
+    # commissions are counted under an assigned_to of ''.
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS commission_counts (
+        status_key INTEGER,
+        assigned_to TEXT,
+        count INTEGER DEFAULT 0,
+        PRIMARY KEY (status_key, assigned_to)
+    );
+    """)
+    cur.execute("DELETE FROM commission_counts;")
+    cur.execute("""
+    INSERT INTO commission_counts(status_key, assigned_to, count)
+    SELECT status_key, COALESCE(assigned_to, ''), COUNT(*) FROM commissions GROUP BY 1, 2;
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS commission_counts_insert AFTER INSERT ON commissions
+    BEGIN
+        INSERT INTO commission_counts(status_key, assigned_to, count)
+        VALUES (NEW.status_key, COALESCE(NEW.assigned_to, ''), 1)
+        ON CONFLICT(status_key, assigned_to) DO UPDATE SET count=count + 1;
+    END;
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS commission_counts_delete AFTER DELETE ON commissions
+    BEGIN
+        UPDATE commission_counts SET count=count - 1
+        WHERE status_key=OLD.status_key AND assigned_to=COALESCE(OLD.assigned_to, '');
+    END;
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS commission_counts_update
+    AFTER UPDATE OF assigned_to, allow_any_artist, accepted, invoiced, paid, finished ON commissions
+    WHEN OLD.status_key IS NOT NEW.status_key OR OLD.assigned_to IS NOT NEW.assigned_to
+    BEGIN
+        UPDATE commission_counts SET count=count - 1
+        WHERE status_key=OLD.status_key AND assigned_to=COALESCE(OLD.assigned_to, '');
+        INSERT INTO commission_counts(status_key, assigned_to, count)
+        VALUES (NEW.status_key, COALESCE(NEW.assigned_to, ''), 1)
+        ON CONFLICT(status_key, assigned_to) DO UPDATE SET count=count + 1;
+    END;
+    """)
+
+
+# The columns of archived_commissions as migration 8 creates it
+ARCHIVE_COLUMNS_V8 = ("id", "timestamp", "name", "email", "twitch", "twitter", "discord", "reference_images",
+                      "description", "expression", "notes", "artist_choice", "if_queue_is_full", "assigned_to",
+                      "allow_any_artist", "hidden", "accepted", "invoiced", "paid", "finished", "channel_name",
+                      "message_id", "counter", "specialty", "status_key", "finished_at")
+
+
+def add_commission_archive(cur: sqlite3.Cursor):
+    # When each commission was finished, so it can be archived once the grace period is over. Commissions finished
+    # before this was tracked start their grace period now.
+    if not has_column(cur, "commissions", "finished_at"):
+        cur.execute("ALTER TABLE commissions ADD COLUMN finished_at TIMESTAMP DEFAULT NULL;")
+    cur.execute("UPDATE commissions SET finished_at=CURRENT_TIMESTAMP WHERE finished AND finished_at IS NULL;")
+    cur.execute("CREATE INDEX IF NOT EXISTS commissions_finished_at ON commissions(finished_at) WHERE status_key = 5;")
+
+    # Finished commissions are moved here once archived, so queries on commissions only ever see live work. The IDs
+    # come from commissions, and status_key is stored as it was when the commission was archived.
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS archived_commissions (
+        id INTEGER PRIMARY KEY,
+        timestamp TIMESTAMP,
+        name TEXT DEFAULT '',
+        email TEXT DEFAULT '',
+        twitch TEXT DEFAULT '',
+        twitter TEXT DEFAULT '',
+        discord TEXT DEFAULT '',
+        reference_images TEXT DEFAULT '',
+        description TEXT DEFAULT '',
+        expression TEXT DEFAULT '',
+        notes TEXT DEFAULT '',
+        artist_choice TEXT DEFAULT '',
+        if_queue_is_full TEXT DEFAULT '',
+        assigned_to TEXT DEFAULT NULL,
+        allow_any_artist BOOLEAN DEFAULT FALSE,
+        hidden BOOLEAN DEFAULT FALSE,
+        accepted BOOLEAN DEFAULT FALSE,
+        invoiced BOOLEAN DEFAULT FALSE,
+        paid BOOLEAN DEFAULT FALSE,
+        finished BOOLEAN DEFAULT FALSE,
+        channel_name TEXT DEFAULT NULL,
+        message_id INTEGER DEFAULT NULL,
+        counter INTEGER DEFAULT NULL,
+        specialty BOOLEAN DEFAULT FALSE,
+        status_key INTEGER,
+        finished_at TIMESTAMP DEFAULT NULL,
+        UNIQUE (timestamp, email)
+    );
+    """)
+    # Every commission, live or archived, for history lookups. The columns are named, so a column added to
+    # commissions later doesn't break the view; it only shows up here once it's added to the archive as well.
+    columns = ", ".join(ARCHIVE_COLUMNS_V8)
+    cur.execute(f"""
+    CREATE VIEW IF NOT EXISTS all_commissions AS
+    SELECT {columns} FROM commissions UNION ALL SELECT {columns} FROM archived_commissions;
+    """)
+    # Archived commissions stay in commission_counts, so the status board's finished total doesn't drop
+    cur.execute("DROP TRIGGER IF EXISTS commission_counts_delete;")
+    cur.execute("""
+    CREATE TRIGGER commission_counts_delete AFTER DELETE ON commissions
+    WHEN NOT EXISTS (SELECT 1 FROM archived_commissions WHERE id=OLD.id)
+    BEGIN
+        UPDATE commission_counts SET count=count - 1
+        WHERE status_key=OLD.status_key AND assigned_to=COALESCE(OLD.assigned_to, '');
+    END;
+    """)
+
+
+# Applied in order. Never edit or reorder a migration that has shipped; add a new one instead.
+MIGRATIONS: List[Migration] = [
+    Migration(1, "Create tables", create_tables),
+    Migration(2, "Add 'specialty' column", add_specialty_column),
+    Migration(3, "Create 'sheet_watermarks' table", add_sheet_watermarks_table),
+    Migration(4, "Add indexes on message_id, channel_name, assigned_to and status flags", add_lookup_indexes),
+    Migration(5, "Create 'status_messages' table", add_status_messages_table),
+    Migration(6, "Add 'first_id' column to 'status_messages'", add_status_page_boundaries),
+    Migration(7, "Add 'status_key' column and 'commission_counts' table", add_status_key_column),
+    Migration(8, "Add 'finished_at' column and 'archived_commissions' table", add_commission_archive),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def migrate(conn: sqlite3.Connection, verbose=False) -> int:
+    """
+    Applies every migration newer than the database's version. Each migration and its version bump run in their own
+    transaction, so a failed step leaves the database at the previous version.
+    :param conn:
+    :param verbose: Print each step as it's applied or skipped
+    :return: The database's version afterwards
+    """
+    isolation_level = conn.isolation_level
+    # Manage the transactions by hand; the sqlite3 module would otherwise commit before DDL statements
+    conn.isolation_level = None
+    cur = conn.cursor()
+    try:
+        for migration in MIGRATIONS:
+            if get_version(cur) >= migration.version:
+                if verbose:
+                    print(f"Skipping migration {migration.version}: {migration.description}")
+                continue
+            print(f"Applying migration {migration.version}: {migration.description}...")
+            cur.execute("BEGIN IMMEDIATE;")
+            try:
+                migration.apply(cur)
+                set_version(cur, migration.version)
+            except BaseException:
+                cur.execute("ROLLBACK;")
+                raise
+            cur.execute("COMMIT;")
+        return get_version(cur)
+    finally:
+        conn.isolation_level = isolation_level
@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import sys
+import threading
+import traceback
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple, Union
+
+# Upper bounds, in seconds, of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+LabelValues = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: dict) -> LabelValues:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: LabelValues, extra: Tuple[str, str]=None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = [(k, v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')) for k, v in pairs]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class Counter:
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.lock = threading.Lock()
+        self.values: Dict[LabelValues, float] = {}
+        REGISTRY.append(self)
+
+    def inc(self, amount: float=1, **labels):
+        key = _labels(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self) -> float:
+        with self.lock:
+            return sum(self.values.values())
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(labels)} {value:g}")
+        return lines
+
+    def summarize(self) -> List[str]:
+        with self.lock:
+            return [f"{self.name}{_format_labels(labels)}: {value:g}" for labels, value in sorted(self.values.items())]
+
+
+class Histogram:
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...]=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # For each set of labels: the count in each bucket (the last one is +Inf), the sum, and the largest value
+        self.values: Dict[LabelValues, Tuple[List[int], float, float]] = {}
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels):
+        key = _labels(labels)
+        with self.lock:
+            counts, total, largest = self.values.get(key) or ([0] * (len(self.buckets) + 1), 0, 0)
+            counts[bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value, max(largest, value))
+
+    @contextmanager
+    def time(self, **labels):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def total_count(self) -> int:
+        with self.lock:
+            return sum(sum(counts) for counts, _, _ in self.values.values())
+
+    def quantile(self, labels: LabelValues, q: float) -> float:
+        """
+        :return: The upper bound of the bucket the q-th quantile falls in, or the largest value seen for the last one
+        """
+        counts, _, largest = self.values[labels]
+        rank = q * sum(counts)
+        seen = 0
+        for bound, count in zip(self.buckets, counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, largest)
+        return largest
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for labels, (counts, total, _) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    le = bound if bound == "+Inf" else f"{bound:g}"
+                    lines.append(f"{self.name}_bucket{_format_labels(labels, ('le', le))} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {total:g}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {sum(counts)}")
+        return lines
+
+    def summarize(self) -> List[str]:
+        lines = []
+        with self.lock:
+            for labels, (counts, total, _) in sorted(self.values.items()):
+                count = sum(counts)
+                lines.append("{}{}: {} in {:.0f} ms avg, p50 <= {:.0f} ms, p99 <= {:.0f} ms".format(
+                    self.name, _format_labels(labels), count, total / count * 1000,
+                    self.quantile(labels, 0.5) * 1000, self.quantile(labels, 0.99) * 1000
+                ))
+        return lines
+
+
+REGISTRY: List[Union[Counter, Histogram]] = []
+
+SYNC_SECONDS = Histogram("commission_sync_seconds", "Time taken by one sheet sync, from fetch to the last new message")
+ROWS_INGESTED = Counter("commission_rows_ingested_total", "New commissions added to the DB by sheet syncs")
+STATUS_REFRESH_SECONDS = Histogram("status_refresh_seconds", "Time taken to bring the status board up to date")
+DB_CALL_SECONDS = Histogram("db_call_seconds", "Time taken by DB calls on the DB thread, by method")
+DB_STATEMENTS = Counter("db_statements_total", "SQL statements executed")
+DISCORD_CALLS = Counter("discord_calls_total", "Discord HTTP API requests, by route")
+DISCORD_CALL_SECONDS = Histogram("discord_call_seconds", "Time taken by Discord HTTP API requests, by route")
+DISCORD_RATE_LIMITS = Counter("discord_rate_limits_total", "Responses from Discord with status 429")
+INTERACTION_ACK_SECONDS = Histogram("interaction_ack_seconds", "Time from a button click arriving until it was acked")
+INTERACTION_SECONDS = Histogram("interaction_seconds", "Time taken to handle a button click, by action")
+
+
+def render() -> str:
+    """
+    :return: Every metric in the Prometheus text exposition format
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+def summarize() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.summarize()
+    return "\n".join(lines) or "No metrics recorded yet"
+
+
+def count_statement(statement: str):
+    # Used as the sqlite3 trace callback
+    DB_STATEMENTS.inc()
+
+
+def instrument_http(http):
+    """
+    Wraps a discord.py HTTPClient so every API request is counted and timed by its route, e.g.
+    "POST /channels/{channel_id}/messages". Interaction responses go through a webhook session instead, and are
+    measured by the button handler.
+    """
+    request = http.request
+    if getattr(request, "instrumented", False):
+        return
+
+    async def timed_request(route, **kwargs):
+        start = perf_counter()
+        try:
+            return await request(route, **kwargs)
+        finally:
+            name = f"{route.method} {route.path}"
+            DISCORD_CALLS.inc(route=name)
+            DISCORD_CALL_SECONDS.observe(perf_counter() - start, route=name)
+
+    timed_request.instrumented = True
+    http.request = timed_request
+
+
+class RateLimitCounter(logging.Handler):
+    """
+    Counts the 429s discord.py logs. It retries rate limited requests itself, so they never reach the caller.
+    """
+
+    def emit(self, record: logging.LogRecord):
+        if str(record.msg).startswith("We are being rate limited"):
+            DISCORD_RATE_LIMITS.inc()
+
+
+def count_rate_limits():
+    logger = logging.getLogger("discord.http")
+    if not any(isinstance(handler, RateLimitCounter) for handler in logger.handlers):
+        logger.addHandler(RateLimitCounter())
+
+
+async def serve(port: int, host="127.0.0.1") -> Optional[asyncio.AbstractServer]:
+    """
+    Serves the metrics for Prometheus to scrape, at http://host:port/metrics
+    :param port: 0 to not serve them
+    :param host: Only local by default
+    """
+    if not port:
+        return None
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            # Skip the headers
+            while (await reader.readline()).strip():
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except Exception:
+            print("Failed to serve metrics.", file=sys.stderr)
+            traceback.print_exc(file=sys.stderr)
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    print(f"Serving metrics at http://{host}:{port}/metrics")
+    return server
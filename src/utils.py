@@ -1,25 +1,87 @@
 import re
+from bisect import bisect_right
+from collections import OrderedDict
 from datetime import datetime
 from enum import Enum
 from json import loads
-from typing import NamedTuple, Tuple, List
+from typing import Dict, NamedTuple, Optional, Tuple, List
 
 from discord import Embed
 
+CONFIG_PATH = "conf/config.json"
+
 CHANNELS = {}
 
 USERS = {}
 
 
-def load_config(filepath="conf/config.json") -> dict:
-    global CHANNELS, USERS
+class ConfigLookups(NamedTuple):
+    channel_by_artist: Dict[str, str]
+    artist_by_member: Dict[int, str]
+
+
+LOOKUPS = ConfigLookups({}, {})
+
+
+class GuildConfig(NamedTuple):
+    channels: Dict[str, str]
+    users: Dict[str, str]
+    lookups: ConfigLookups
+    # The guild's own section of the config, which can also set its spreadsheet_id and form_sources
+    section: dict
+
+
+# The top-level channels and users, for a bot that serves a single guild
+DEFAULT_GUILD = GuildConfig({}, {}, LOOKUPS, {})
+
+# Each guild in the config's "guilds" section, by guild ID. Empty when the bot serves a single guild.
+GUILDS: Dict[int, GuildConfig] = {}
+
+
+def load_config(filepath=None) -> dict:
+    """
+    Reads the config file and compiles its lookups. Everything is read and built before any global is replaced, so
+    calling this again to reload never leaves the config half-applied, and a bad file leaves the old config in place.
+    :param filepath: Defaults to the file loaded last time
+    :return: The whole config
+    """
+    global CONFIG_PATH, CHANNELS, USERS, LOOKUPS, DEFAULT_GUILD, GUILDS
+    filepath = filepath or CONFIG_PATH
     with open(filepath) as f:
         j = loads(f.read())
-        CHANNELS = j["channels"]
-        USERS = j["users"]
+    channels, users = j.get("channels", {}), j.get("users", {})
+    lookups = compile_lookups(channels, users)
+    guilds = {
+        int(guild_id): GuildConfig(section["channels"], section["users"],
+                                   compile_lookups(section["channels"], section["users"]), section)
+        for guild_id, section in j.get("guilds", {}).items()
+    }
+    CONFIG_PATH, CHANNELS, USERS, LOOKUPS = filepath, channels, users, lookups
+    DEFAULT_GUILD, GUILDS = GuildConfig(channels, users, lookups, {}), guilds
     return j
 
 
+def get_guild_config(guild_id: Optional[int]) -> Optional[GuildConfig]:
+    """
+    :param guild_id: None for the top-level config
+    :return: The guild's config, or None if the guild isn't in the config
+    """
+    if guild_id is None:
+        return DEFAULT_GUILD
+    return GUILDS.get(guild_id)
+
+
+def compile_lookups(channels: Dict[str, str], users: Dict[str, str]) -> ConfigLookups:
+    channel_by_artist = {}
+    for channel_name, artist_name in channels.items():
+        # The first channel listed for an artist wins
+        channel_by_artist.setdefault(artist_name, channel_name)
+    return ConfigLookups(
+        channel_by_artist=channel_by_artist,
+        artist_by_member={int(member_id): name for member_id, name in users.items()},
+    )
+
+
 class StatusTuple(NamedTuple):
     color: int
     name: str
@@ -55,10 +117,49 @@ def get_status(allow_any_artist: bool, accepted: bool, invoiced: bool, paid: boo
         return Status.ClaimableExclusive
 
 
-def build_embed(id: int, timestamp: str, name: str, email: str, description: str, expression: str, notes: str,
-                reference_images: str, artist_choice: str, twitch: str, twitter: str, discord: str, hidden: bool,
-                allow_any_artist: bool, accepted: bool, invoiced: bool, paid: bool, finished: bool, specialty: bool,
-                **kwargs) -> Tuple[str, Embed]:
+_status_by_key = {status.value.sort_key: status for status in Status}
+
+
+def get_status_by_key(status_key: int) -> Status:
+    """
+    :param status_key: The commission's status_key column, which the database derives the same way as get_status
+    :return:
+    """
+    return _status_by_key[status_key]
+
+
+# The commission columns that affect what build_embed renders
+RENDER_FIELDS = ("id", "timestamp", "name", "email", "description", "expression", "notes", "reference_images",
+                 "artist_choice", "twitch", "twitter", "discord", "hidden", "allow_any_artist", "accepted", "invoiced",
+                 "paid", "finished", "specialty")
+RENDER_CACHE_SIZE = 1024
+_render_cache: "OrderedDict[tuple, Tuple[str, Embed]]" = OrderedDict()
+
+
+def build_embed(**commission) -> Tuple[str, Embed]:
+    """
+    Renders the message content and embed for a commission, memoized on the values of its RENDER_FIELDS. The least
+    recently used renders are evicted once there are more than RENDER_CACHE_SIZE.
+    :param commission:
+    :return: The content and embed. The embed is shared with every other caller that renders the same values, so it
+        must not be modified.
+    """
+    key = tuple(commission[field] for field in RENDER_FIELDS)
+    rendered = _render_cache.get(key)
+    if rendered is None:
+        rendered = render_embed(**commission)
+        _render_cache[key] = rendered
+        if len(_render_cache) > RENDER_CACHE_SIZE:
+            _render_cache.popitem(last=False)
+    else:
+        _render_cache.move_to_end(key)
+    return rendered
+
+
+def render_embed(id: int, timestamp: str, name: str, email: str, description: str, expression: str, notes: str,
+                 reference_images: str, artist_choice: str, twitch: str, twitter: str, discord: str, hidden: bool,
+                 allow_any_artist: bool, accepted: bool, invoiced: bool, paid: bool, finished: bool, specialty: bool,
+                 **kwargs) -> Tuple[str, Embed]:
     # print("Unused kwargs: {}".format(kwargs))
 
     status = get_status(allow_any_artist, accepted, invoiced, paid, finished)
@@ -110,6 +211,23 @@ def build_embed(id: int, timestamp: str, name: str, email: str, description: str
     return content, embed
 
 
+def embeds_match(sent_embeds: List[Embed], embed: Embed) -> bool:
+    """
+    Checks whether a message's embeds show the same thing as the given embed. Only the parts build_embed sets are
+    compared, since Discord fills in extra attributes on the embeds it sends back.
+    :param sent_embeds:
+    :param embed:
+    :return:
+    """
+    if len(sent_embeds) != 1:
+        return False
+    sent = sent_embeds[0]
+    return (sent.description or "") == (embed.description or "") and \
+        sent.color == embed.color and \
+        sent.thumbnail.url == embed.thumbnail.url and \
+        [(f.name, f.value, f.inline) for f in sent.fields] == [(f.name, f.value, f.inline) for f in embed.fields]
+
+
 def add_field(embed: Embed, name: str, value: str, inline=False, force_add=False) -> bool:
     message_truncated = False
     if len(value) > 1024:
@@ -134,44 +252,111 @@ def get_url(text: str) -> str:
     return m.group("url") if m else None
 
 
-def build_commissions_status_page(commissions: List[dict]) -> str:
-    s = "Commissions status:\n```"
-    row_fmt = "\n {:^02} | {:^24} | {:^36} | {:^20}"
-    s += row_fmt.format("ID", "NAME", "STATUS", "ASSIGNED TO")
-    row_fmt = row_fmt.replace("^", "<")
+STATUS_ROWS_PER_PAGE = 16
+STATUS_ROW_FMT = "\n {:<2} | {:<24} | {:<36} | {:<20}"
+
+
+def build_commissions_status_rows(commissions: List[dict]) -> List[Tuple[int, str]]:
+    """
+    Renders one status board row for each commission
+    :param commissions: The active commissions, in ID order, as returned by Db.get_active_commissions
+    :return: (id, row) for each commission
+    """
+    rows = []
     for commission in commissions:
-        commission["status"] = get_status(**commission)
-    sorted_commissions = sorted(commissions, key=lambda c: c["status"].value.sort_key)
-    finished_commissions = 0
-    for commission in sorted_commissions:
-        if commission["status"] == Status.Finished:
-            finished_commissions += 1
-            continue
+        status = get_status_by_key(commission["status_key"])
         if commission["channel_name"] == "voided-queue":
             status_name = "Voided"
         else:
-            status_name = commission["status"].value.name.format(commission["assigned_to"])
-        s += row_fmt.format(
+            status_name = status.value.name.format(commission["assigned_to"])
+        # Cut every column to its width, so a page of rows always fits in one message
+        rows.append((commission["id"], STATUS_ROW_FMT.format(
             commission["id"],
-            commission["name"],
-            "{} {}".format(commission["status"].value.emoji, status_name),
-            str(commission["assigned_to"])
-        )
-    s += "\n\nFinished commissions: {}".format(finished_commissions)
-    s += "\n```"
-    return s
+            commission["name"][:24],
+            "{} {}".format(status.value.emoji, status_name)[:36],
+            str(commission["assigned_to"])[:20]
+        )))
+    return rows
 
 
-def get_channel_name(i_want_this_artist: str) -> str:
-    for channel_name, artist_name in CHANNELS.items():
-        if artist_name == i_want_this_artist:
-            return channel_name
-    return "incoming-commissions"
+def paginate_commissions_status(ids: List[int], first_ids: List[int]) -> List[int]:
+    """
+    Splits the status board into pages of at most STATUS_ROWS_PER_PAGE rows. The previous page boundaries are kept
+    whenever they still work, so a change to one commission only changes the page it's on, even as other commissions
+    finish and drop off the board.
+    :param ids: The IDs of the active commissions, in order
+    :param first_ids: The first ID of each page last time, in order
+    :return: The first ID of each page
+    """
+    if first_ids:
+        # The first page always starts at 0, and every row past the last boundary lands on the last page
+        counts = [0] * len(first_ids)
+        for i in ids:
+            counts[max(bisect_right(first_ids, i) - 1, 0)] += 1
+        pages_needed = max(1, -(-len(ids) // STATUS_ROWS_PER_PAGE))
+        overflowing = [page for page, count in enumerate(counts) if count > STATUS_ROWS_PER_PAGE]
+        if len(first_ids) <= 2 * pages_needed + 1:
+            if not overflowing:
+                return first_ids
+            if overflowing == [len(first_ids) - 1]:
+                # The usual case: new commissions filled up the last page, so only add pages after it
+                last_ids = [i for i in ids if i >= first_ids[-1]]
+                return first_ids + last_ids[STATUS_ROWS_PER_PAGE::STATUS_ROWS_PER_PAGE]
+    # Start over with full pages, when there are no boundaries yet or too many pages have emptied out
+    return [0] + ids[STATUS_ROWS_PER_PAGE::STATUS_ROWS_PER_PAGE]
+
+
+def build_commissions_status_pages(commissions: List[dict], finished_commissions: int,
+                                   first_ids: List[int]=None) -> Tuple[List[str], List[int]]:
+    """
+    Builds the status board as a list of messages
+    :param commissions: The active commissions, in ID order
+    :param finished_commissions: How many commissions are finished
+    :param first_ids: The first ID of each page last time, see paginate_commissions_status
+    :return: The content of each page, and the first ID of each page
+    """
+    rows = build_commissions_status_rows(commissions)
+    first_ids = paginate_commissions_status([i for i, _ in rows], first_ids or [])
+    page_rows = [[] for _ in first_ids]
+    for i, row in rows:
+        page_rows[max(bisect_right(first_ids, i) - 1, 0)].append(row)
+    pages = []
+    for page, rows_on_page in enumerate(page_rows):
+        s = "Commissions status:\n```" if page == 0 else "```"
+        s += STATUS_ROW_FMT.replace("<", "^").format("ID", "NAME", "STATUS", "ASSIGNED TO")
+        s += "".join(rows_on_page)
+        if page == len(page_rows) - 1:
+            s += "\n\nFinished commissions: {}".format(finished_commissions)
+        s += "\n```"
+        pages.append(s)
+    return pages, first_ids
+
+
+def get_channel_name(i_want_this_artist: str, lookups: ConfigLookups=None) -> str:
+    return (lookups or LOOKUPS).channel_by_artist.get(i_want_this_artist, "incoming-commissions")
+
+
+def parse_sheet_range(sheet_range: str) -> Tuple[str, str, int, str, Optional[int]]:
+    """
+    Splits an A1-notation range like "Form Responses 1!A2:M" or "Form Responses 1!A2:M500" into its sheet name, start
+    column, start row, end column and end row
+    :param sheet_range:
+    :return: The end row is None if the range runs to the bottom of the sheet
+    """
+    m = re.fullmatch(r"(?P<sheet>.+)!(?P<start_col>[A-Z]+)(?P<start_row>\d+):(?P<end_col>[A-Z]+)(?P<end_row>\d*)",
+                     sheet_range)
+    if not m:
+        raise ValueError("Unsupported sheet range: {}".format(sheet_range))
+    start_row = int(m.group("start_row"))
+    end_row = int(m.group("end_row")) if m.group("end_row") else None
+    if end_row is not None and end_row < start_row:
+        raise ValueError("Sheet range ends before it starts: {}".format(sheet_range))
+    return m.group("sheet"), m.group("start_col"), start_row, m.group("end_col"), end_row
 
 
 def ts_to_dt(ts):
     return datetime.strptime(ts, "%m/%d/%Y %H:%M:%S")
 
 
-def get_name_by_member_id(member_id: int):
-    return USERS.get(str(member_id))
+def get_name_by_member_id(member_id: int, lookups: ConfigLookups=None):
+    return (lookups or LOOKUPS).artist_by_member.get(int(member_id))
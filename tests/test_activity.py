@@ -0,0 +1,95 @@
+import asyncio
+import io
+import unittest
+from contextlib import redirect_stderr
+
+from src.bot.activity import MAX_MESSAGE_LENGTH, ActivityLog, pack, truncate
+
+
+class TestPack(unittest.TestCase):
+
+    def test_fills_a_message_exactly(self):
+        # Two lines and the newline between them make exactly one full message
+        first = "a" * 1000
+        second = "b" * (MAX_MESSAGE_LENGTH - 1001)
+        self.assertEqual(pack([first, second]), [first + "\n" + second])
+
+    def test_one_character_over_starts_a_new_message(self):
+        first = "a" * 1000
+        second = "b" * (MAX_MESSAGE_LENGTH - 1000)
+        self.assertEqual(pack([first, second]), [first, second])
+
+    def test_lines_are_never_split(self):
+        lines = ["x" * 700 for _ in range(10)]
+        messages = pack(lines)
+        self.assertEqual(len(messages), 5)
+        self.assertEqual("\n".join(messages).split("\n"), lines)
+        for message in messages:
+            self.assertLessEqual(len(message), MAX_MESSAGE_LENGTH)
+
+    def test_nothing_to_pack(self):
+        self.assertEqual(pack([]), [])
+
+    def test_truncate(self):
+        self.assertEqual(truncate("short"), "short")
+        long = truncate("x" * (MAX_MESSAGE_LENGTH + 10))
+        self.assertEqual(len(long), MAX_MESSAGE_LENGTH)
+        self.assertTrue(long.endswith("..."))
+
+
+class TestActivityLog(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.sent = []
+
+        async def send(text: str):
+            self.sent.append(text)
+
+        self.log = ActivityLog(send, flush_seconds=3600, immediate_events=["claim"])
+
+    async def asyncTearDown(self):
+        if self.log.flush_task is not None:
+            self.log.flush_task.cancel()
+
+    async def test_immediate_events_skip_the_buffer(self):
+        await self.log.add("hide", "buffered")
+        await self.log.add("claim", "right away")
+        self.assertEqual(self.sent, ["right away"])
+        self.assertEqual(self.log.lines, ["buffered"])
+
+    async def test_flushes_when_the_next_line_wouldnt_fit(self):
+        first = "a" * 1000
+        second = "b" * (MAX_MESSAGE_LENGTH - 1001)
+        await self.log.add("hide", first)
+        await self.log.add("hide", second)
+        # Exactly full, but nothing has overflowed yet
+        self.assertEqual(self.sent, [])
+        self.assertEqual(self.log.buffered_length, MAX_MESSAGE_LENGTH)
+        await self.log.add("hide", "c")
+        self.assertEqual(self.sent, [first + "\n" + second])
+        self.assertEqual(self.log.lines, ["c"])
+        self.assertEqual(self.log.buffered_length, 1)
+
+    async def test_flushes_after_flush_seconds(self):
+        self.log.flush_seconds = 0.01
+        await self.log.add("hide", "one")
+        await self.log.add("show", "two")
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.sent, ["one\ntwo"])
+        self.assertEqual(self.log.lines, [])
+
+    async def test_failed_send_doesnt_keep_lines(self):
+        async def fail(text: str):
+            raise RuntimeError("Discord is down")
+
+        self.log.send = fail
+        await self.log.add("hide", "lost")
+        with redirect_stderr(io.StringIO()) as stderr:
+            await self.log.flush()
+        self.assertIn("Failed to send activity digest.", stderr.getvalue())
+        self.assertEqual(self.log.lines, [])
+        self.assertIsNone(self.log.flush_task)
+
+
+if __name__ == "__main__":
+    unittest.main()
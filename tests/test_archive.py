@@ -0,0 +1,173 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from src.db.db import Db, close_database
+from src.db.migrations import LATEST_VERSION, MIGRATIONS, get_version, set_version
+
+# Far enough in the past for any grace period
+LONG_AGO = "2000-01-01 00:00:00"
+
+FINISHED = {"assigned_to": "Artist 1", "accepted": True, "invoiced": True, "paid": True, "finished": True,
+            "hidden": True}
+
+
+def stamp(n: int) -> str:
+    # A form response timestamp, in the format the sheet uses
+    return f"01/01/2024 10:00:{n:02d}"
+
+
+def make_row(timestamp: str, email: str, artist_choice="Any artist") -> list:
+    # In the order ingest_commissions takes them
+    return [timestamp, email, "", "", "", "", "Description", "", "", artist_choice, "", "Name"]
+
+
+class TestArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, "test.db")
+        self.db = Db(self.filename)
+
+    def tearDown(self):
+        self.db.close()
+        close_database(self.filename)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def add_commission(self, timestamp: str, message_id: int=None, finished_at: str=None, **flags) -> dict:
+        values = dict(flags, timestamp=timestamp, email="user@example.com", channel_name="artist-1-queue",
+                      message_id=message_id, finished_at=finished_at)
+        sql = f"""
+            INSERT INTO commissions({", ".join(values)}) VALUES ({", ".join("?" * len(values))}) RETURNING *;
+        """
+        return self.db.fetch_dict(sql, list(values.values()))
+
+    def count_mismatches(self) -> list:
+        # Rows that are in one of commission_counts and a fresh count of all_commissions, but not the other
+        sql = """
+            SELECT * FROM (
+                SELECT status_key, COALESCE(assigned_to, '') AS assigned_to, COUNT(*) AS count FROM all_commissions
+                GROUP BY 1, 2
+                EXCEPT SELECT status_key, assigned_to, count FROM commission_counts WHERE count > 0
+            ) UNION ALL SELECT * FROM (
+                SELECT status_key, assigned_to, count FROM commission_counts WHERE count > 0
+                EXCEPT SELECT status_key, COALESCE(assigned_to, ''), COUNT(*) FROM all_commissions GROUP BY 1, 2
+            );
+        """
+        return self.db.cur.execute(sql).fetchall()
+
+    def test_only_finished_commissions_past_the_grace_period_move(self):
+        old = self.add_commission(stamp(1), message_id=11, finished_at=LONG_AGO, **FINISHED)
+        recent = self.add_commission(stamp(2), message_id=12, finished_at="9999-01-01 00:00:00", **FINISHED)
+        active = self.add_commission(stamp(3), message_id=13, assigned_to="Artist 1", accepted=True)
+        archived = self.db.archive_finished_commissions(60)
+        self.assertEqual([(c["id"], c["channel_name"], c["message_id"]) for c in archived],
+                         [(old["id"], "artist-1-queue", 11)])
+        live_ids = [c["id"] for c in self.db.get_all_commissions() if c["id"] != old["id"]]
+        self.assertEqual(live_ids, [recent["id"], active["id"]])
+        self.assertEqual(dict(self.db.fetch_dict("SELECT * FROM archived_commissions;", [])), dict(old))
+        self.assertIsNone(self.db.get_commission_by_message_id(11))
+        self.assertEqual(self.db.get_commission_by_id(old["id"]), old)
+        self.assertEqual(self.db.archive_finished_commissions(60), [])
+
+    def test_counts_keep_archived_commissions(self):
+        self.add_commission(stamp(1), finished_at=LONG_AGO, **FINISHED)
+        self.add_commission(stamp(2), assigned_to="Artist 1", accepted=True)
+        before = self.db.get_status_counts()
+        self.db.archive_finished_commissions(60)
+        self.assertEqual(self.db.get_status_counts(), before)
+        self.assertEqual(self.count_mismatches(), [])
+        # Deleting a live commission still takes it off the counts
+        self.db.cur.execute("DELETE FROM commissions WHERE timestamp=?;", [stamp(2)])
+        self.assertEqual(self.db.get_status_counts(), {5: 1})
+        self.assertEqual(self.count_mismatches(), [])
+
+    def test_archived_commissions_are_not_ingested_again(self):
+        self.add_commission(stamp(1), finished_at=LONG_AGO, **FINISHED)
+        self.db.archive_finished_commissions(60)
+        keys = self.db.get_existing_commission_keys([(stamp(1), "user@example.com"), (stamp(2), "user@example.com")])
+        self.assertEqual(keys, {(stamp(1), "user@example.com")})
+
+    def test_ingest_after_everything_is_archived(self):
+        first = self.db.ingest_commissions([make_row(stamp(1), "a@example.com"), make_row(stamp(2), "b@example.com")])
+        for commission in first:
+            self.db.cur.execute("UPDATE commissions SET assigned_to='Artist 1', accepted=TRUE, invoiced=TRUE, "
+                                "paid=TRUE, finished=TRUE, finished_at=? WHERE id=?;", [LONG_AGO, commission["id"]])
+        self.assertEqual(len(self.db.archive_finished_commissions(60)), 2)
+        # The live table is empty now, but IDs carry on from the archived ones
+        new = self.db.ingest_commissions([make_row(stamp(3), "c@example.com"),
+                                          make_row(stamp(4), "d@example.com", "Artist 2")])
+        self.assertEqual([c["timestamp"] for c in new], [stamp(3), stamp(4)])
+        self.assertGreater(min(c["id"] for c in new), max(c["id"] for c in first))
+        self.assertEqual(new[1]["assigned_to"], "Artist 2")
+        ids = [c["id"] for c in self.db.get_all_commissions()]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual(len(ids), 4)
+        self.assertEqual(self.count_mismatches(), [])
+
+    def test_archiving_survives_a_new_column(self):
+        self.db.cur.execute("ALTER TABLE commissions ADD COLUMN extra TEXT DEFAULT '';")
+        self.add_commission(stamp(1), finished_at=LONG_AGO, **FINISHED)
+        self.assertEqual(len(self.db.archive_finished_commissions(60)), 1)
+        self.assertEqual(len(list(self.db.get_all_commissions())), 1)
+
+
+class TestMigrations(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, "test.db")
+
+    def tearDown(self):
+        close_database(self.filename)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def create_database(self, version: int) -> sqlite3.Connection:
+        """
+        :return: A connection to a database built by the migrations up to and including version
+        """
+        conn = sqlite3.connect(self.filename)
+        cur = conn.cursor()
+        for migration in MIGRATIONS[:version]:
+            migration.apply(cur)
+        if version == 0:
+            cur.execute("CREATE TABLE version (version INTEGER PRIMARY KEY);")
+            cur.execute("INSERT INTO version (version) VALUES (0);")
+        set_version(cur, version)
+        conn.commit()
+        return conn
+
+    def test_migrate_from_version_0(self):
+        self.create_database(0).close()
+        with Db(self.filename) as db:
+            self.assertEqual(get_version(db.cur), LATEST_VERSION)
+            self.assertEqual(list(db.get_all_commissions()), [])
+            # Channels are only added by the bot, from its config
+            self.assertEqual(db.cur.execute("SELECT COUNT(*) FROM channels;").fetchone()[0], 0)
+            self.assertEqual(db.archive_finished_commissions(0), [])
+
+    def test_migrate_commissions_from_version_2(self):
+        conn = self.create_database(2)
+        conn.executemany("""
+            INSERT INTO commissions(timestamp, email, assigned_to, accepted, invoiced, paid, finished, message_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+        """, [(stamp(1), "a@example.com", "Artist 1", True, True, True, True, 11),
+              (stamp(2), "b@example.com", "Artist 1", True, False, False, False, 12),
+              (stamp(3), "c@example.com", None, False, False, False, False, 13)])
+        conn.commit()
+        conn.close()
+        with Db(self.filename) as db:
+            self.assertEqual(get_version(db.cur), LATEST_VERSION)
+            self.assertEqual(db.get_status_counts(), {5: 1, 2: 1, 1: 1})
+            # Commissions that were already finished start their grace period when the migration runs
+            finished = db.get_commission_by_message_id(11)
+            self.assertIsNotNone(finished["finished_at"])
+            self.assertEqual([c["message_id"] for c in db.archive_finished_commissions(0)], [11])
+            self.assertEqual(db.get_status_counts(), {5: 1, 2: 1, 1: 1})
+            self.assertEqual([c["message_id"] for c in db.get_all_commissions()], [11, 12, 13])
+
+
+if __name__ == "__main__":
+    unittest.main()
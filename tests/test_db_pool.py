@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from src.db.db import Db, close_database
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, "test.db")
+
+    def tearDown(self):
+        close_database(self.filename)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def count_channels(self) -> int:
+        with Db(self.filename, readonly=True) as db:
+            return db.cur.execute("SELECT COUNT(*) FROM channels;").fetchone()[0]
+
+    def test_writer_is_reused(self):
+        with Db(self.filename) as db:
+            writer = db.conn
+        with Db(self.filename) as db:
+            self.assertIs(db.conn, writer)
+
+    def test_overlapping_dbs_get_their_own_connections(self):
+        first = Db(self.filename)
+        second = Db(self.filename)
+        self.assertIsNot(first.conn, second.conn)
+        # The second caller's rollback can't undo the first caller's changes
+        with first:
+            first.add_channels(["first"])
+            with self.assertRaises(RuntimeError):
+                with second:
+                    raise RuntimeError()
+        self.assertEqual(self.count_channels(), 1)
+        with Db(self.filename) as db:
+            self.assertIs(db.conn, first.pool.writer)
+
+    def test_uncommitted_changes_are_rolled_back_on_close(self):
+        db = Db(self.filename)
+        db.add_channels(["dropped"])
+        db.close()
+        self.assertEqual(self.count_channels(), 0)
+        with Db(self.filename) as db:
+            db.add_channels(["kept"])
+        self.assertEqual(self.count_channels(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import asyncio
+import unittest
+
+from src.bot.locks import LockRegistry
+
+
+class TestLockRegistry(unittest.IsolatedAsyncioTestCase):
+
+    async def test_first_in_first_out(self):
+        locks = LockRegistry()
+        order = []
+
+        async def work(i: int):
+            async with locks.hold("key"):
+                order.append(i)
+                await asyncio.sleep(0)
+
+        await asyncio.gather(*[work(i) for i in range(10)])
+        self.assertEqual(order, list(range(10)))
+        self.assertEqual(len(locks), 0)
+
+    async def test_keys_run_in_parallel(self):
+        locks = LockRegistry()
+        held = asyncio.Event()
+
+        async def hold_a():
+            async with locks.hold("a"):
+                held.set()
+                await asyncio.sleep(10)
+
+        holder = asyncio.create_task(hold_a())
+        await held.wait()
+        # A different key doesn't wait for "a"
+        async with locks.hold("b"):
+            self.assertEqual(len(locks), 2)
+        holder.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await holder
+        self.assertEqual(len(locks), 0)
+
+    async def test_cancelled_waiter_is_evicted(self):
+        locks = LockRegistry()
+        release = asyncio.Event()
+        held = asyncio.Event()
+
+        async def holder():
+            async with locks.hold("key"):
+                held.set()
+                await release.wait()
+
+        async def waiter():
+            async with locks.hold("key"):
+                self.fail("A cancelled waiter shouldn't get the lock")
+
+        holding = asyncio.create_task(holder())
+        await held.wait()
+        waiting = asyncio.create_task(waiter())
+        await asyncio.sleep(0)
+        self.assertEqual(locks.users["key"], 2)
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        # The holder still has the lock, so it's kept until the holder is done
+        self.assertEqual(locks.users["key"], 1)
+        release.set()
+        await holding
+        self.assertEqual(len(locks), 0)
+        self.assertEqual(locks.users, {})
+        # The key can be used again afterwards
+        async with locks.hold("key"):
+            self.assertEqual(len(locks), 1)
+        self.assertEqual(len(locks), 0)
+
+    async def test_released_after_an_exception(self):
+        locks = LockRegistry()
+        with self.assertRaises(ValueError):
+            async with locks.hold("key"):
+                raise ValueError()
+        self.assertEqual(len(locks), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
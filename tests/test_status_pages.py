@@ -0,0 +1,106 @@
+import unittest
+from typing import List
+
+from src import utils
+from src.utils import STATUS_ROWS_PER_PAGE, build_commissions_status_pages, paginate_commissions_status
+
+
+def make_commissions(ids, name="Name", status_key=0, assigned_to=None) -> List[dict]:
+    return [{"id": i, "name": name, "status_key": status_key, "channel_name": "incoming-commissions",
+             "assigned_to": assigned_to} for i in ids]
+
+
+class TestStatusPages(unittest.TestCase):
+
+    def test_empty_board(self):
+        pages, first_ids = build_commissions_status_pages([], 3)
+        self.assertEqual(first_ids, [0])
+        self.assertEqual(len(pages), 1)
+        self.assertTrue(pages[0].startswith("Commissions status:"))
+        self.assertIn("Finished commissions: 3", pages[0])
+
+    def test_emptied_board(self):
+        # An empty board needs one page, so up to three are kept
+        _, first_ids = build_commissions_status_pages(make_commissions(range(1, 3 * STATUS_ROWS_PER_PAGE + 1)), 0)
+        pages, new_first_ids = build_commissions_status_pages([], 40, first_ids)
+        self.assertEqual(new_first_ids, first_ids)
+        self.assertIn("Finished commissions: 40", pages[-1])
+        _, first_ids = build_commissions_status_pages(make_commissions(range(1, 4 * STATUS_ROWS_PER_PAGE + 1)), 0)
+        pages, new_first_ids = build_commissions_status_pages([], 40, first_ids)
+        self.assertEqual(new_first_ids, [0])
+        self.assertEqual(len(pages), 1)
+
+    def test_full_pages_from_scratch(self):
+        ids = list(range(1, 2 * STATUS_ROWS_PER_PAGE + 5))
+        first_ids = paginate_commissions_status(ids, [])
+        self.assertEqual(first_ids, [0, ids[STATUS_ROWS_PER_PAGE], ids[2 * STATUS_ROWS_PER_PAGE]])
+
+    def test_boundaries_stay_after_finishes(self):
+        commissions = make_commissions(range(1, 3 * STATUS_ROWS_PER_PAGE + 1))
+        pages, first_ids = build_commissions_status_pages(commissions, 0)
+        # Finishing commissions on the first page only changes the first page, and the last for its finished count
+        remaining = [c for c in commissions if c["id"] not in (2, 5, 9)]
+        new_pages, new_first_ids = build_commissions_status_pages(remaining, 3, first_ids)
+        self.assertEqual(new_first_ids, first_ids)
+        self.assertNotEqual(new_pages[0], pages[0])
+        self.assertEqual(new_pages[1], pages[1])
+
+    def test_new_commissions_fill_the_last_page(self):
+        commissions = make_commissions(range(1, STATUS_ROWS_PER_PAGE + 5))
+        pages, first_ids = build_commissions_status_pages(commissions, 0)
+        more = commissions + make_commissions(range(100, 105))
+        new_pages, new_first_ids = build_commissions_status_pages(more, 0, first_ids)
+        self.assertEqual(new_first_ids, first_ids)
+        self.assertEqual(new_pages[0], pages[0])
+
+    def test_overflow_appends_pages(self):
+        commissions = make_commissions(range(1, 2 * STATUS_ROWS_PER_PAGE + 1))
+        pages, first_ids = build_commissions_status_pages(commissions, 0)
+        new_ids = list(range(100, 100 + STATUS_ROWS_PER_PAGE + 1))
+        new_pages, new_first_ids = build_commissions_status_pages(commissions + make_commissions(new_ids), 0,
+                                                                  first_ids)
+        self.assertEqual(new_first_ids, first_ids + [new_ids[0], new_ids[-1]])
+        self.assertEqual(new_pages[0], pages[0])
+        # The old last page only loses the finished count, which moves to the new last page
+        self.assertEqual(new_pages[1], pages[1].replace("\n\nFinished commissions: 0", ""))
+
+    def test_emptied_pages_are_kept_until_too_many(self):
+        commissions = make_commissions(range(1, 4 * STATUS_ROWS_PER_PAGE + 1))
+        _, first_ids = build_commissions_status_pages(commissions, 0)
+        # Emptying a page keeps the boundaries, so the pages after it don't change
+        remaining = [c for c in commissions if not STATUS_ROWS_PER_PAGE < c["id"] <= 2 * STATUS_ROWS_PER_PAGE]
+        pages, kept_first_ids = build_commissions_status_pages(remaining, 0, first_ids)
+        self.assertEqual(kept_first_ids, first_ids)
+        self.assertEqual(len(pages), 4)
+        # Once there are more than twice as many pages as needed, plus one, the board is rebuilt from full pages
+        remaining = remaining[:STATUS_ROWS_PER_PAGE // 2]
+        pages, new_first_ids = build_commissions_status_pages(remaining, 0, first_ids)
+        self.assertEqual(new_first_ids, [0])
+        self.assertEqual(len(pages), 1)
+
+    def test_overflow_before_the_last_page_starts_over(self):
+        ids = list(range(1, 3 * STATUS_ROWS_PER_PAGE + 1))
+        # Boundaries that would put too many rows on the first page
+        first_ids = [0, ids[STATUS_ROWS_PER_PAGE + 2], ids[2 * STATUS_ROWS_PER_PAGE]]
+        self.assertEqual(paginate_commissions_status(ids, first_ids),
+                         [0, ids[STATUS_ROWS_PER_PAGE], ids[2 * STATUS_ROWS_PER_PAGE]])
+
+    def test_every_page_fits_in_a_message(self):
+        long_name = "N" * 200
+        commissions = []
+        for status in utils.Status:
+            if status.value.sort_key < utils.Status.Finished.value.sort_key:
+                commissions += make_commissions(range(len(commissions) + 1, len(commissions) + 41), long_name,
+                                                status.value.sort_key, "A" * 100)
+        pages, first_ids = build_commissions_status_pages(commissions, 10 ** 9)
+        self.assertGreater(len(pages), 1)
+        for page in pages:
+            self.assertLess(len(page), 2000)
+        # Pages keep their rows after finishes, so a page can't grow past its limit either
+        pages, _ = build_commissions_status_pages(commissions[::2], 10 ** 9, first_ids)
+        for page in pages:
+            self.assertLess(len(page), 2000)
+
+
+if __name__ == "__main__":
+    unittest.main()
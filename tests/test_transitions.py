@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from src.db.db import Db, TransitionConflict, close_database
+
+# Every state a commission can be in when a button is clicked, as the flags that are set on top of the defaults
+STATES = {
+    "unassigned, any artist": {"allow_any_artist": True},
+    "unassigned, exclusive": {},
+    "assigned, any artist": {"assigned_to": "Artist 1", "allow_any_artist": True},
+    "assigned, exclusive": {"assigned_to": "Artist 1"},
+    "accepted": {"assigned_to": "Artist 1", "accepted": True},
+    "invoiced": {"assigned_to": "Artist 1", "accepted": True, "invoiced": True},
+    "paid": {"assigned_to": "Artist 1", "accepted": True, "invoiced": True, "paid": True},
+    "finished": {"assigned_to": "Artist 1", "accepted": True, "invoiced": True, "paid": True, "finished": True,
+                 "hidden": True},
+}
+
+# The states each transition is allowed from
+ALLOWED = {
+    "claim": {"unassigned, any artist", "unassigned, exclusive"},
+    "reject": {"assigned, any artist", "assigned, exclusive", "accepted"},
+    "accept": {"assigned, any artist", "assigned, exclusive"},
+    "show": set(STATES),
+    "hide": set(STATES),
+    "invoice": {"accepted"},
+    "pay": {"invoiced"},
+    "finish": {"accepted", "invoiced", "paid"},
+}
+
+# What each transition leaves changed
+EXPECTED = {
+    "claim": {"assigned_to": "Artist 2", "accepted": True},
+    "reject": {"assigned_to": None, "accepted": False},
+    "accept": {"accepted": True},
+    "show": {"hidden": False},
+    "hide": {"hidden": True},
+    "invoice": {"invoiced": True},
+    "pay": {"paid": True},
+    "finish": {"finished": True, "hidden": True},
+}
+
+COLUMNS = ["assigned_to", "allow_any_artist", "accepted", "invoiced", "paid", "finished", "hidden"]
+
+
+class TestTransitions(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, "test.db")
+        self.db = Db(self.filename)
+
+    def tearDown(self):
+        self.db.close()
+        close_database(self.filename)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def add_commission(self, message_id: int, state: dict) -> dict:
+        values = dict({column: None if column == "assigned_to" else False for column in COLUMNS}, **state)
+        sql = f"""
+            INSERT INTO commissions(timestamp, email, message_id, {", ".join(COLUMNS)})
+            VALUES (?, ?, ?, {", ".join("?" * len(COLUMNS))}) RETURNING *;
+        """
+        return self.db.fetch_dict(sql, [str(message_id), "user@example.com", message_id] +
+                                  [values[column] for column in COLUMNS])
+
+    def test_every_action_from_every_state(self):
+        message_id = 0
+        for action, allowed_states in ALLOWED.items():
+            for state_name, state in STATES.items():
+                message_id += 1
+                with self.subTest(action=action, state=state_name):
+                    before = self.add_commission(message_id, state)
+                    values = {"assigned_to": "Artist 2", "accepted": True} if action == "claim" else {}
+                    if state_name in allowed_states:
+                        after = self.db.transition(message_id, action, before["status_key"], **values)
+                        for column in COLUMNS:
+                            expected = EXPECTED[action].get(column, before[column])
+                            self.assertEqual(after[column], expected, column)
+                        if action == "finish":
+                            self.assertIsNotNone(after["finished_at"])
+                    else:
+                        with self.assertRaises(TransitionConflict):
+                            self.db.transition(message_id, action, before["status_key"], **values)
+                        self.assertEqual(self.db.get_commission_by_message_id(message_id), before)
+
+    def test_expected_state_must_match(self):
+        commission = self.add_commission(1, STATES["assigned, exclusive"])
+        with self.assertRaises(TransitionConflict) as context:
+            self.db.transition(1, "accept", commission["status_key"] + 1)
+        self.assertEqual(context.exception.current, commission)
+        self.assertTrue(self.db.transition(1, "accept", commission["status_key"])["accepted"])
+
+    def test_unknown_message(self):
+        with self.assertRaises(TransitionConflict) as context:
+            self.db.transition(404, "hide")
+        self.assertIsNone(context.exception.current)
+
+
+if __name__ == "__main__":
+    unittest.main()